@@ -0,0 +1,595 @@
+import argparse, json, os, platform, random, threading, time, types
+from midi_router import MidiPorts, VirtualBackend, AsyncCore, PollingCore, Roland, Arturia, RouterStats, MIDI_MESSAGE_TYPES, MIDI_NOTE_VALUES
+
+# Benchmarks for the router hot paths - run with: python benchmarks.py <benchmark>
+
+def virtual_ports(threaded=False, capture=False, writers=True, track_latency=False, core="threads"):
+    # core="asyncio" routes on an AsyncCore event loop running on its own thread, core="polling" on a PollingCore
+    if core == "asyncio":
+        async_core = AsyncCore(VirtualBackend(threaded=threaded, capture=capture), writers=writers)
+        midiports = async_core.midiports
+        async_core.start_thread()
+    elif core == "polling":
+        poller = PollingCore(VirtualBackend(threaded=threaded, capture=capture), writers=writers)
+        midiports = poller.midiports
+        poller.start()
+    else:
+        midiports = MidiPorts(VirtualBackend(threaded=threaded, capture=capture), writers=writers)
+    midiports.open_all_ports()
+    if track_latency:
+        midiports.start_latency_tracking(RouterStats())  # fresh histograms for every scenario
+    return midiports
+
+# Frozen copies of the original if/elif callbacks (Roland._callback / Arturia._callback before the dispatch tables),
+# kept for side-by-side comparison: they decode MIDI_MESSAGE_TYPES strings, scan the mapping dicts with get_dict_key
+# and send straight to the port. Only the module-level names they used are renamed (threads, get_dict_key,
+# note_value_to_name) - the pad-press branch still starts a thread on the device's own _makeTransition, but the
+# benchmark traffic never presses a pad
+legacy_threads = []
+
+def legacy_roland_callback(self, msg, data):
+    status_byte, data_byte_1, data_byte_2 = msg[0]
+    msg_type = MIDI_MESSAGE_TYPES[status_byte//16]  # alternatively use bitwise operation to extract first 4 bits: msg_type = (status_byte & 0xF0) >> 4
+    msg_channel = (status_byte%16) + 1   # alternatively use bitwise operation to extract last 4 bits: msg_channel = status_byte & 0x0F
+    # Catch messages to ignore
+    if msg_type == "System Message":
+        print(f"UNEXPECTED SYSTEM MESSAGE: from {self.NAME}")
+        return
+    if msg_channel != self.MIDI_CHANNEL and msg_channel != self.MIDI_CHANNEL_BASS: 
+        print(f"UNEXPECTED CHANNEL MESSAGE: from {self.NAME} on channel {msg_channel}")
+        return
+    # Update exp_pedal_value
+    if msg_type == "Control Change" and data_byte_1 == 7:      # control change from expression pedal
+        self.exp_pedal_value = data_byte_2
+    # Tweak velocities if bass mode on
+    if self.bass_mode and msg_type == "Note On" and data_byte_1 <= self.BASS_UPPER_KEY and msg_channel == self.MIDI_CHANNEL:
+        data_byte_2 = int(data_byte_2 * (127 - self.exp_pedal_value) / 127)
+    # Forward midi message
+    msg = [status_byte, data_byte_1, data_byte_2]
+    self.midiports.midiout_loopbe.send_message(msg)
+
+def legacy_arturia_callback(self, msg, data):
+    status_byte, data_byte_1, data_byte_2 = msg[0]
+    status_byte, data_byte_1, data_byte_2 = msg[0]
+    msg_type = MIDI_MESSAGE_TYPES[status_byte//16]
+    msg_channel = (status_byte%16) + 1
+    # Catch messages to ignore
+    if msg_type == "System Message":
+        print(f"UNEXPECTED SYSTEM MESSAGE: from {self.NAME}")
+        return
+    if msg_channel != self.MIDI_CHANNEL: 
+        print(f"UNEXPECTED CHANNEL MESSAGE: from {self.NAME} on channel ({msg_channel})")
+        return
+    if msg_type == "Note Off":
+        return
+    if msg_type == "Channel Pressure (Aftertouch)":
+        return  #Ignore all aftertouch messages from pads
+    if msg_type == "Polyphonic Key Pressure (Aftertouch)":
+        return  #Ignore all aftertouch messages from pads
+    # Messages requiring action
+    if msg_type == "Control Change":
+        #Mod wheel - used as another way of setting self.target_knob_name value
+        if data_byte_1 == 1:
+            data_byte_1 = self.KNOB_CC[self.target_knob_name]
+            self.knob_values[self.target_knob_name] = data_byte_2
+            knob_id = int(self.KNOB_SYSEX_ID[self.target_knob_name])
+            self._updateKnobPosition(knob_id, data_byte_2)
+            msg = [status_byte, data_byte_1, data_byte_2]
+            self.midiports.midiout_loopbe.send_message(msg)
+            return
+        # knob turn
+        knob_name = legacy_get_dict_key(self.KNOB_CC, data_byte_1)
+        if knob_name:
+            #Check knob value not undergoing transition - stop transition if so
+            if knob_name in self.PAD_LINKED_TO_KNOB:
+                if knob_name in legacy_threads:
+                    legacy_threads.remove(knob_name)
+                    self._updatePadColour(knob_name, 2)
+                    # knob_id = int(self.KNOB_SYSEX_ID[knob_name])
+                    knob_id = self.KNOB_SYSEX_ID[knob_name]
+                    knob_value = self.knob_values[knob_name]
+                    self._updateKnobPosition(knob_id, knob_value)
+                    return 0
+            #Send knob value            
+            self.knob_values[knob_name] = data_byte_2
+        msg = [status_byte, data_byte_1, data_byte_2]
+        self.midiports.midiout_loopbe.send_message(msg)
+        return
+    if msg_type == "Note On":
+        pad_name = legacy_get_dict_key(self.PAD_NOTE_VALUES, data_byte_1)
+        if pad_name and pad_name in self.PAD_ROTARY_SWITCH:  # Pressed pad for switching organ rotary
+            status_byte = 0xB0 + self.MIDI_CHANNEL_ORGAN - 1  # Change status_byte to CC on specified midi channel (must be same as organ channel)
+            data_byte_1 = 1  # Change to CC1 (normally mod wheel)
+            if self.rotary_on == True:
+                self.rotary_on = False
+                data_byte_2 = 0
+            else:
+                self.rotary_on = True
+                data_byte_2 = 127
+            msg = [status_byte, data_byte_1, data_byte_2]
+            self.midiports.midiout_loopbe.send_message(msg)
+            return
+        elif pad_name:  # Pressed another pad
+            transitionTime = 128 - data_byte_2
+            transitionTime = transitionTime*transitionTime
+            t = threading.Thread(target=self._makeTransition, args=(pad_name, transitionTime))
+            t.start()
+            return
+        elif data_byte_1 >= MIDI_NOTE_VALUES["C3"] and data_byte_1 < MIDI_NOTE_VALUES["C4"]:   # Pressed key in bottom octave on Arturia Minilab
+            self.base_pitch = data_byte_1 - MIDI_NOTE_VALUES["C1"]   # Value for equivalent note in octave C1-B1
+            self._sendAllNotesOff()
+            return
+        elif data_byte_1 >= MIDI_NOTE_VALUES["C4"] and data_byte_1 < MIDI_NOTE_VALUES["C5"]:  #Pressed key in upper octave on Arturia Minilab
+            self.octave_transpose = data_byte_1 - MIDI_NOTE_VALUES["C4"]
+            data_byte_1 = self.base_pitch + (12*self.octave_transpose)
+            if data_byte_1 in self.notes_on:   #Turn off note
+                self.notes_on.remove(data_byte_1)
+                status_byte = 0x80 + self.MIDI_CHANNEL - 1    #Note Off on specified midi channel
+                data_byte_2 = 0
+                msg = [status_byte, data_byte_1, data_byte_2]
+                self.midiports.midiout_loopbe.send_message(msg)
+                return
+            else:   #Turn on note
+                self.notes_on.append(data_byte_1)
+                msg = [status_byte, data_byte_1, data_byte_2]
+                self.midiports.midiout_loopbe.send_message(msg)
+                return
+        else:
+            # msg = [status_byte, data_byte_1, data_byte_2]
+            # self.midiports.midiout_loopbe.send_message(msg)
+            print(f"UNEXPECTED CHANNEL MESSAGE: Note On for {legacy_note_value_to_name(data_byte_1)} is outside of expected range (C3-B4)")
+            return
+    # If reaches here, log unexpected message after sending
+    msg = [status_byte, data_byte_1, data_byte_2]
+    self.midiports.midiout_loopbe.send_message(msg)
+    print(f"UNEXPECTED CHANNEL MESSAGE: {msg} from Arteria")
+
+def legacy_note_value_to_name(value):
+    for key, val in MIDI_NOTE_VALUES.items():
+        if val == value:
+            return key
+    return None
+
+def legacy_get_dict_key(my_dict, my_val):
+    # list out key and values
+    key_list = list(my_dict.keys())
+    val_list = list(my_dict.values())
+    # return key which matches value (or None if not found)
+    try:
+        position = val_list.index(my_val)
+        return key_list[position]
+    except ValueError:
+        return None
+
+def roland_messages(count):
+    # Keyboard traffic on the organ and bass channels with expression pedal sweeps
+    rng = random.Random(1)
+    messages = []
+    for i in range(count):
+        kind = rng.random()
+        if kind < 0.4:
+            messages.append(([0x90 + rng.choice((0, 1)), rng.randint(36, 96), rng.randint(1, 127)], 0.0))
+        elif kind < 0.8:
+            messages.append(([0x80 + rng.choice((0, 1)), rng.randint(36, 96), 0], 0.0))
+        else:
+            messages.append(([0xB0, 7, rng.randint(0, 127)], 0.0))
+    return messages
+
+def arturia_messages(count):
+    # Pad aftertouch dominated traffic with knob turns and releases (no pad presses so no sweeps are started)
+    rng = random.Random(2)
+    messages = []
+    for i in range(count):
+        kind = rng.random()
+        if kind < 0.6:
+            messages.append(([0xA2, rng.randint(0, 15), rng.randint(0, 127)], 0.0))
+        elif kind < 0.8:
+            messages.append(([0xB2, rng.randint(102, 117), rng.randint(0, 127)], 0.0))
+        else:
+            messages.append(([0x82, rng.randint(0, 15), 0], 0.0))
+    return messages
+
+def time_callback(callback, messages, repeats):
+    best = None
+    for r in range(repeats):
+        start = time.perf_counter_ns()
+        for msg in messages:
+            callback(msg, None)
+        elapsed = time.perf_counter_ns() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / len(messages)
+
+def bench_dispatch(args):
+    ports = virtual_ports(writers=False)  # routing only - leave the output writers out of it
+    roland = Roland(ports)
+    roland.bass_mode = True
+    arturia = Arturia(ports)
+    cases = [
+        ("Roland", roland, legacy_roland_callback, roland_messages(args.messages)),
+        ("Arturia", arturia, legacy_arturia_callback, arturia_messages(args.messages)),
+    ]
+    # The device's own callbacks: _callback (counters only) and _timedCallback (what STATS_FILE / CALLBACK_TIMING attach)
+    print(f"{'device':<10}{'if/elif chain':>18}{'dispatch table':>18}{'speedup':>10}{'timed':>15}{'speedup':>10}")
+    for name, device, legacy_callback, messages in cases:
+        legacy_ns = time_callback(types.MethodType(legacy_callback, device), messages, args.repeats)
+        table_ns = time_callback(device._callback, messages, args.repeats)
+        timed_ns = time_callback(device._timedCallback, messages, args.repeats)
+        print(f"{name:<10}{legacy_ns:>15.0f} ns{table_ns:>15.0f} ns{legacy_ns / table_ns:>9.2f}x"
+              f"{timed_ns:>12.0f} ns{legacy_ns / timed_ns:>9.2f}x")
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return None
+    rank = max(1, int(-(-fraction * len(sorted_values) // 1)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def summarise(samples_us):
+    # Percentiles plus a power-of-two microsecond histogram ({bucket upper bound in us: count})
+    samples_us = sorted(samples_us)
+    histogram = {}
+    for sample in samples_us:
+        bound = 1
+        while bound < sample:
+            bound *= 2
+        histogram[bound] = histogram.get(bound, 0) + 1
+    return {
+        "count": len(samples_us),
+        "mean_us": sum(samples_us) / len(samples_us) if samples_us else None,
+        "p50_us": percentile(samples_us, 0.5),
+        "p99_us": percentile(samples_us, 0.99),
+        "p99.9_us": percentile(samples_us, 0.999),
+        "max_us": samples_us[-1] if samples_us else None,
+        "histogram_us": {str(bound): histogram[bound] for bound in sorted(histogram)},
+    }
+
+def inject_at_rate(midiin, messages, rate, clock):
+    # Injects messages evenly spaced at rate messages per second (rate 0 means as fast as possible)
+    # and returns the timestamp each message was injected at
+    timestamps = []
+    start = clock()
+    for i, message in enumerate(messages):
+        if rate:
+            remaining = start + (i / rate) - clock()
+            if remaining > 0:
+                time.sleep(remaining)  # sleeping rather than spinning lets the delivery thread take the GIL
+        timestamp = clock()
+        timestamps.append(timestamp)
+        midiin.inject(message, timestamp)
+    if midiin.backend.threaded:
+        midiin.wait_idle()
+    return timestamps
+
+def routing_latency(midiports, midiin, midiout, messages, rate):
+    # Every scenario message produces exactly one output message so inputs and outputs pair up in order
+    midiout.clear()
+    in_timestamps = inject_at_rate(midiin, messages, rate, midiports.backend.clock)
+    midiports.wait_outputs_idle()
+    out_timestamps = [timestamp for timestamp, message in midiout.sent]
+    if len(out_timestamps) != len(in_timestamps):
+        raise RuntimeError(f"expected {len(in_timestamps)} output messages but captured {len(out_timestamps)} (at high rates the output writers coalesce CCs - try --direct-output)")
+    return [(sent - received) * 1e6 for received, sent in zip(in_timestamps, out_timestamps)]
+
+def stop_ports(midiports):
+    # Stops the threads virtual_ports started, so they do not run on into the next case
+    if midiports.poller is not None:
+        midiports.poller.stop()
+    if midiports.handoff is not None:
+        midiports.handoff.stop()
+    midiports.close_all_ports()
+
+def latency_result(midiports, samples_us):
+    # summarise() plus, with --track-latency, the router's own queue / python / output split for each input port
+    result = summarise(samples_us)
+    if midiports.latency:
+        result["breakdown"] = {}
+        for attribute, latency in midiports.latency.items():
+            if latency.queue.count:
+                result["breakdown"][attribute] = {part: {"p50_us": histogram.percentile(0.5) / 1000, "p99_us": histogram.percentile(0.99) / 1000,
+                                                         "max_us": histogram.max / 1000}
+                                                  for part, histogram in (("queue", latency.queue), ("python", latency.python), ("output", latency.output))
+                                                  if histogram.count}
+    return result
+
+def scenario_roland_passthrough(args):
+    midiports = virtual_ports(args.delivery == "thread", capture=True, writers=not args.direct_output, track_latency=args.track_latency, core=args.core)
+    roland = Roland(midiports)
+    roland.initialise_callback()
+    result = latency_result(midiports, routing_latency(midiports, midiports.midiin_roland, midiports.midiout_loopbe, [msg[0] for msg in roland_messages(args.messages)], args.rate))
+    stop_ports(midiports)
+    return result
+
+def scenario_roland_bass_mode(args):
+    midiports = virtual_ports(args.delivery == "thread", capture=True, writers=not args.direct_output, track_latency=args.track_latency, core=args.core)
+    roland = Roland(midiports)
+    roland.bass_mode = True
+    roland.initialise_callback()
+    rng = random.Random(3)
+    messages = []
+    for i in range(args.messages):
+        if i % 8 == 0:
+            messages.append([0xB0, 7, rng.randint(0, 127)])  # expression pedal
+        else:
+            messages.append([0x90, rng.randint(24, roland.BASS_UPPER_KEY), rng.randint(1, 127)])
+    result = latency_result(midiports, routing_latency(midiports, midiports.midiin_roland, midiports.midiout_loopbe, messages, args.rate))
+    stop_ports(midiports)
+    return result
+
+def scenario_arturia_knob_cc(args):
+    midiports = virtual_ports(args.delivery == "thread", capture=True, writers=not args.direct_output, track_latency=args.track_latency, core=args.core)
+    arturia = Arturia(midiports)
+    arturia.initialise_callback()
+    rng = random.Random(4)
+    status_byte = 0xB0 + arturia.MIDI_CHANNEL - 1
+    knob_ccs = list(arturia.KNOB_CC.values())
+    messages = [[status_byte, rng.choice(knob_ccs), rng.randint(0, 127)] for i in range(args.messages)]
+    result = latency_result(midiports, routing_latency(midiports, midiports.midiin_arturia, midiports.midiout_loopbe, messages, args.rate))
+    stop_ports(midiports)
+    return result
+
+def scenario_arturia_note_toggle(args):
+    midiports = virtual_ports(args.delivery == "thread", capture=True, writers=not args.direct_output, track_latency=args.track_latency, core=args.core)
+    arturia = Arturia(midiports)
+    arturia.initialise_callback()
+    rng = random.Random(5)
+    status_byte = 0x90 + arturia.MIDI_CHANNEL - 1
+    messages = [[status_byte, rng.randint(60, 71), rng.randint(1, 127)] for i in range(args.messages)]  # upper octave (C4-B4)
+    result = latency_result(midiports, routing_latency(midiports, midiports.midiin_arturia, midiports.midiout_loopbe, messages, args.rate))
+    stop_ports(midiports)
+    return result
+
+def scenario_sweep_steps(args):
+    # Triggers concurrent pad sweeps and measures how far each step lands from its intended time (relative to the pad press)
+    midiports = virtual_ports(args.delivery == "thread", capture=True, writers=not args.direct_output, track_latency=args.track_latency, core=args.core)
+    arturia = Arturia(midiports)
+    arturia.initialise_callback()
+    status_byte = 0x90 + arturia.MIDI_CHANNEL - 1
+    velocity = args.sweep_velocity
+    period = ((128 - velocity) ** 2) * 0.00003
+    pads = [pad_name for pad_name in arturia.PAD_NOTE_VALUES if pad_name not in arturia.PAD_ROTARY_SWITCH]
+    pads = [pad_name for pad_name in pads if arturia.PAD_LINKED_TO_KNOB[pad_name] != arturia.target_knob_name][:args.sweeps]
+    midiports.midiout_loopbe.clear()
+    started = {}
+    for pad_name in pads:
+        started[arturia.KNOB_CC[arturia.PAD_LINKED_TO_KNOB[pad_name]]] = midiports.backend.clock()
+        midiports.midiin_arturia.inject([status_byte, arturia.PAD_NOTE_VALUES[pad_name], velocity])
+    if midiports.backend.threaded:
+        midiports.midiin_arturia.wait_idle()
+    expected_duration = period * (arturia.TRANSITION_STEPS - 1)  # first step is sent straight away
+    deadline = time.perf_counter() + expected_duration * 3 + 1
+    while arturia.scheduler.active_count() and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    midiports.wait_outputs_idle()
+    step_times = {}
+    for timestamp, message in midiports.midiout_loopbe.sent:
+        step_times.setdefault(message[1], []).append(timestamp)
+    step_errors = []
+    duration_errors = []
+    for cc, start in started.items():
+        times = step_times.get(cc, [])
+        for index, timestamp in enumerate(times):
+            if arturia.SWEEP_MODE == "values":
+                intended = expected_duration * (index + 1) / len(times)  # one step per distinct value (assumes no skips)
+            else:
+                intended = period * index
+            step_errors.append(abs((timestamp - start) - intended) * 1e6)
+        if times:
+            duration_errors.append(((times[-1] - start) - expected_duration) * 1e6)
+    result = summarise(step_errors)
+    result["sweep_mode"] = arturia.SWEEP_MODE
+    result["steps_sent"] = sum(len(times) for cc, times in step_times.items() if cc in started)
+    result["step_period_us"] = period * 1e6
+    result["sweep_duration_error_us"] = summarise(duration_errors)
+    result["late_policy"] = arturia.scheduler.late_policy
+    result["steps_skipped"] = arturia.scheduler.stats.steps_skipped
+    stop_ports(midiports)
+    return result
+
+SCENARIOS = {
+    "roland_passthrough": scenario_roland_passthrough,
+    "roland_bass_mode": scenario_roland_bass_mode,
+    "arturia_knob_cc": scenario_arturia_knob_cc,
+    "arturia_note_toggle": scenario_arturia_note_toggle,
+    "sweep_steps": scenario_sweep_steps,
+}
+
+def bench_latency(args):
+    # Latency / jitter suite - sample values are microseconds (for sweep_steps: deviation of each step from its period)
+    names = args.scenarios.split(",") if args.scenarios else list(SCENARIOS)
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {"messages": args.messages, "rate": args.rate, "delivery": args.delivery, "core": args.core, "direct_output": args.direct_output,
+                   "track_latency": args.track_latency, "sweeps": args.sweeps, "sweep_velocity": args.sweep_velocity},
+        "scenarios": {},
+    }
+    print(f"{'scenario':<22}{'count':>8}{'p50 us':>10}{'p99 us':>10}{'p99.9 us':>10}{'max us':>10}")
+    for name in names:
+        result = SCENARIOS[name](args)
+        results["scenarios"][name] = result
+        print(f"{name:<22}{result['count']:>8}{result['p50_us']:>10.1f}{result['p99_us']:>10.1f}{result['p99.9_us']:>10.1f}{result['max_us']:>10.1f}")
+        for attribute, parts in result.get("breakdown", {}).items():
+            for part, summary in parts.items():
+                print(f"  {attribute + ' ' + part:<28}{summary['p50_us']:>10.1f}{summary['p99_us']:>10.1f}{'':>10}{summary['max_us']:>10.1f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {args.output}")
+
+def bench_batch(args):
+    # Offline path (midi_batch, needs NumPy) against the realtime callbacks on the same messages
+    from midi_batch import BATCH_ROUTERS, events_from_messages, events_to_messages, realtime_reference, make_device
+    from midi_router import load_device_profile, DEFAULT_PROFILE
+    profile = load_device_profile(DEFAULT_PROFILE)
+    cases = [("roland", roland_messages(args.messages)), ("arturia", arturia_messages(args.messages))]
+    print(f"{'device':<10}{'callbacks':>16}{'batch':>16}{'speedup':>10}  output")
+    for name, messages in cases:
+        events = events_from_messages([message for message, delta_time in messages])
+        started = time.perf_counter()
+        realtime = realtime_reference(name, events, profile, bass_mode=True)
+        realtime_s = time.perf_counter() - started
+        router = BATCH_ROUTERS[name][1](make_device(name, profile, bass_mode=True))
+        batch_s = None
+        for r in range(args.repeats):
+            started = time.perf_counter()
+            output = router.process(events)
+            elapsed = time.perf_counter() - started
+            if batch_s is None or elapsed < batch_s:
+                batch_s = elapsed
+        same = "identical" if events_to_messages(output) == realtime else "DIFFERENT"
+        print(f"{name:<10}{len(events) / realtime_s / 1e6:>9.2f} Mev/s{len(events) / batch_s / 1e6:>9.2f} Mev/s{realtime_s / batch_s:>9.1f}x  {same}")
+
+def thread_context_switches(exclude):
+    # Voluntary + involuntary context switches of every thread in this process except the given native thread ids
+    # (Linux /proc - elsewhere the whole process from getrusage, so the injecting thread is included; None on Windows)
+    try:
+        total = 0
+        for tid in os.listdir("/proc/self/task"):
+            if int(tid) in exclude:
+                continue
+            with open(f"/proc/self/task/{tid}/status") as f:
+                for line in f:
+                    if line.startswith(("voluntary_ctxt_switches", "nonvoluntary_ctxt_switches")):
+                        total += int(line.split()[1])
+        return total
+    except OSError:
+        pass
+    try:
+        import resource  # Unix only
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_nvcsw + usage.ru_nivcsw
+
+def input_mode_case(args, core, rate):
+    # Roland passthrough on one core for args.seconds at rate messages per second (0 = idle) - context switches and CPU
+    # exclude the injecting (main) thread so only the router's own threads are counted
+    # Output is sent straight from the routing thread, so the writers neither add threads nor coalesce at 10k msg/s
+    midiports = virtual_ports(True, capture=True, writers=False, core=core)
+    roland = Roland(midiports)
+    roland.initialise_callback()
+    messages = [msg[0] for msg in roland_messages(int(rate * args.seconds))]
+    exclude = {threading.get_native_id()}
+    time.sleep(0.1)  # let every thread reach its idle state
+    switches = thread_context_switches(exclude)
+    cpu = time.process_time()
+    injector_cpu = time.thread_time()
+    started = time.perf_counter()
+    if rate:
+        latency = routing_latency(midiports, midiports.midiin_roland, midiports.midiout_loopbe, messages, rate)
+    else:
+        time.sleep(args.seconds)
+        latency = []
+    elapsed = time.perf_counter() - started
+    router_cpu = (time.process_time() - cpu) - (time.thread_time() - injector_cpu)
+    switches_after = thread_context_switches(exclude)
+    stop_ports(midiports)
+    result = summarise(latency)
+    result["context_switches_per_s"] = None if switches is None else (switches_after - switches) / elapsed
+    result["cpu_percent"] = max(router_cpu, 0) / elapsed * 100
+    return result
+
+def bench_input_modes(args):
+    # Callback threads against the polling thread (and the asyncio core) at idle, 1k and 10k messages per second
+    cases = [(core, rate) for rate in (0, 1000, 10000) for core in CORES]
+    results = {"python": platform.python_version(), "platform": platform.platform(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "config": {"seconds": args.seconds}, "cases": []}
+    print(f"{'core':<10}{'rate':>8}{'ctx sw/s':>10}{'cpu %':>8}{'p50 us':>10}{'p99 us':>10}{'max us':>10}")
+    for core, rate in cases:
+        result = input_mode_case(args, core, rate)
+        result.update(core=core, rate=rate)
+        results["cases"].append(result)
+        latency = f"{result['p50_us']:>10.1f}{result['p99_us']:>10.1f}{result['max_us']:>10.1f}" if result["count"] else f"{'-':>10}{'-':>10}{'-':>10}"
+        switches = f"{result['context_switches_per_s']:>10.0f}" if result["context_switches_per_s"] is not None else f"{'-':>10}"
+        print(f"{core:<10}{rate:>8}{switches}{result['cpu_percent']:>8.1f}{latency}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {args.output}")
+
+def threaded_devices_rate(count, messages):
+    # count Roland devices in this process, each fed from its own thread - the GIL-bound baseline for bench_shards
+    from midi_shards import shard_load
+    feeds = []
+    for i in range(count):
+        midiports = MidiPorts(VirtualBackend(capture=False), writers=False)
+        midiports.open_all_ports()
+        roland = Roland(midiports)
+        roland.initialise_callback()
+        feeds.append((midiports.midiin_roland, shard_load(roland, messages)))
+    def feed(midiin, load):
+        for message in load:
+            midiin.inject(message, 0.0)
+    threads = [threading.Thread(target=feed, args=feed_args) for feed_args in feeds]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return count * messages / (time.perf_counter() - started)
+
+def sharded_devices_rate(count, messages):
+    # count Roland devices in worker processes of their own (midi_shards), all output through the writer process
+    # (which sends straight to the ports, like the one process baseline)
+    from midi_shards import ShardedRouter
+    router = ShardedRouter(devices=("roland",) * count, backend="virtual", writers=False, load=messages)
+    router.start()
+    started = time.perf_counter()
+    router.go()
+    forwarded = router.join()
+    return forwarded / (time.perf_counter() - started)
+
+def bench_shards(args):
+    # Throughput as devices (and so processes) are added: one process with a thread per device against a worker
+    # process per device - messages is per device
+    cores = os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] < max(args.max_shards, 1):
+        counts.append(min(counts[-1] * 2, args.max_shards))
+    results = {"python": platform.python_version(), "platform": platform.platform(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "config": {"messages": args.messages, "cores": cores}, "cases": []}
+    print(f"{cores} cores")
+    print(f"{'devices':>8}{'one process':>18}{'sharded':>18}{'speedup':>10}")
+    for count in counts:
+        threaded = threaded_devices_rate(count, args.messages)
+        sharded = sharded_devices_rate(count, args.messages)
+        results["cases"].append({"devices": count, "one_process_msgs_per_s": threaded, "sharded_msgs_per_s": sharded})
+        print(f"{count:>8}{threaded / 1000:>12.1f} kmsg/s{sharded / 1000:>12.1f} kmsg/s{sharded / threaded:>9.2f}x")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {args.output}")
+
+CORES = ("threads", "polling", "asyncio")
+
+BENCHMARKS = {
+    "batch": bench_batch,
+    "dispatch": bench_dispatch,
+    "input_modes": bench_input_modes,
+    "latency": bench_latency,
+    "shards": bench_shards,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the python midi router")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--messages", type=int, default=100000, help="messages per run")
+    parser.add_argument("--repeats", type=int, default=5, help="runs per case (best is reported)")
+    parser.add_argument("--rate", type=float, default=1000, help="input messages per second (0 for as fast as possible)")
+    parser.add_argument("--delivery", choices=("thread", "sync"), default="thread", help="virtual input delivery mode")
+    parser.add_argument("--core", choices=CORES, default="threads", help="route on the callback threads, an asyncio event loop or one polling thread")
+    parser.add_argument("--direct-output", action="store_true", help="send from the routing threads instead of the per-port output writers")
+    parser.add_argument("--track-latency", action="store_true", help="also report the router's queue / python / output latency split")
+    parser.add_argument("--scenarios", help="comma separated latency scenarios (default: all)")
+    parser.add_argument("--sweeps", type=int, default=4, help="concurrent pad sweeps in the sweep_steps scenario")
+    parser.add_argument("--sweep-velocity", type=int, default=110, help="pad velocity for the sweep_steps scenario")
+    parser.add_argument("--max-shards", type=int, default=max(4, os.cpu_count() or 1), help="largest device count in the shards benchmark")
+    parser.add_argument("--seconds", type=float, default=2, help="length of each input_modes case")
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+import argparse, struct, sys, time
+import numpy as np
+from midi_router import (MidiPorts, VirtualBackend, Roland, Arturia, load_device_profile, DEFAULT_PROFILE,
+                         MIDI_NOTE_VALUES, CAPTURE_MAGIC)
+
+# Offline processing of Standard MIDI Files through the Roland / Arturia routing rules
+# Events are held as columnar NumPy arrays and every rule transform runs once per file as a vectorised operation
+# NumPy is only needed here - midi_router.py itself does not import it
+# Usage: python midi_batch.py {roland,arturia} in.mid out.mid   |   python midi_batch.py verify {roland,arturia} in.mid
+
+EVENT_DTYPE = np.dtype([("time", "i8"), ("status", "i2"), ("data1", "i2"), ("data2", "i2"), ("size", "i1")])
+NO_RULE = -1
+CAPTURE_DTYPE = np.dtype([("header", "u1"), ("status", "u1"), ("data1", "u1"), ("data2", "u1"), ("delta_us", "<u4")])  # see InputCapture
+
+def make_events(count):
+    return np.zeros(count, dtype=EVENT_DTYPE)
+
+def events_from_messages(messages, times=None):
+    # messages are rtmidi style lists ([status, data1, data2] or [status, data1]) - times default to 0, 1, 2 ...
+    events = make_events(len(messages))
+    events["time"] = np.arange(len(messages)) if times is None else times
+    for row, message in enumerate(messages):
+        events["status"][row] = message[0]
+        events["size"][row] = len(message)
+        if len(message) > 1:
+            events["data1"][row] = message[1]
+        if len(message) > 2:
+            events["data2"][row] = message[2]
+    return events
+
+def events_to_messages(events):
+    messages = []
+    for status, data1, data2, size in zip(events["status"].tolist(), events["data1"].tolist(), events["data2"].tolist(), events["size"].tolist()):
+        messages.append([status, data1, data2][:size])
+    return messages
+
+def load_capture_array(path):
+    # Memory-maps an InputCapture file as a CAPTURE_DTYPE array (zero-copy, read only)
+    with open(path, "rb") as f:
+        if f.read(8) != CAPTURE_MAGIC:
+            raise ValueError(f"{path}: not an input capture")
+    return np.memmap(path, dtype=CAPTURE_DTYPE, mode="r", offset=16)
+
+def capture_to_events(records, port_id):
+    # Event array (time in microseconds since the capture started) for one port of a capture
+    # Continued records (messages longer than three bytes, i.e. SysEx) are left out like the router ignores them
+    on_port = records[(records["header"] & 0x0F) == port_id]
+    continued = (on_port["header"] & 0x40) != 0
+    times = np.cumsum(on_port["delta_us"], dtype=np.int64)[~continued]
+    on_port = on_port[~continued]
+    events = make_events(len(on_port))
+    events["time"] = times
+    events["status"] = on_port["status"]
+    events["data1"] = on_port["data1"]
+    events["data2"] = on_port["data2"]
+    events["size"] = (on_port["header"] >> 4) & 0x03
+    events = events[events["status"] < 0xF0]
+    return events
+
+class BatchRouter:
+    # Runs a device's routing rules (see Rule / compile_rules) over an event array
+    # Rules are matched with a (status, data1) -> rule index table, then each rule's transform is applied to all of its
+    # events at once by the method of the same name on the subclass
+    # The batch starts from the device's current state (exp pedal, bass mode, base pitch, rotary) with no notes held
+    def __init__(self, device):
+        self.device = device
+        self.rules = device._buildRules()
+        for rule in self.rules:
+            if rule.data2 is not None:
+                raise ValueError(f"{device.NAME}: rules matching on data2 are not supported offline")
+            if len(rule.outputs) > 1:
+                raise ValueError(f"{device.NAME}: rules with more than one output are not supported offline")
+            if rule.transform is not None and not hasattr(self, rule.transform.__name__):
+                raise ValueError(f"{device.NAME}: no batch version of {rule.transform.__name__}")
+        self.rule_table = self._buildRuleTable()
+
+    def _buildRuleTable(self):
+        table = np.full((256, 128), NO_RULE, dtype=np.int16)
+        for status in range(0x80, 0x100):
+            msg_type, msg_channel = status >> 4, (status & 0x0F) + 1
+            candidates = [index for index, rule in enumerate(self.rules) if rule.matches_status(msg_type, msg_channel)]
+            for data1 in range(128):
+                for index in candidates:
+                    if self.rules[index].data1 is None or data1 in self.rules[index].data1:
+                        table[status, data1] = index
+                        break
+        return table
+
+    def process(self, events):
+        # Returns the events the device would send to its output, in the order the realtime callbacks send them
+        self._events = events
+        self._rule_ids = self.rule_table[events["status"], events["data1"] & 0x7F]
+        self._extra = []  # (after event index, sub order, rows) for messages sent while handling another event
+        out = events.copy()
+        keep = np.zeros(len(events), dtype=bool)
+        for index, rule in enumerate(self.rules):
+            mask = self._rule_ids == index
+            if not mask.any():
+                continue
+            sends = mask
+            if rule.transform is not None:
+                sends = getattr(self, rule.transform.__name__)(events, out, mask)
+            if rule.outputs:
+                keep |= sends
+        kept = np.flatnonzero(keep)
+        after = [kept] + [extra[0] for extra in self._extra]
+        sub = [np.full(len(kept), -1)] + [extra[1] for extra in self._extra]
+        rows = np.concatenate([out[kept]] + [extra[2] for extra in self._extra])
+        self._events = self._rule_ids = self._extra = None
+        return rows[np.lexsort((np.concatenate(sub), np.concatenate(after)))]
+
+    def _maskFor(self, handler_name):
+        # Events matched by the rule(s) whose transform is handler_name
+        indexes = [index for index, rule in enumerate(self.rules) if rule.transform is not None and rule.transform.__name__ == handler_name]
+        return np.isin(self._rule_ids, indexes)
+
+    def _lastValue(self, mask, column, initial):
+        # For every event, the value of column at the latest event in mask up to and including it (initial before the first)
+        last = np.where(mask, np.arange(len(mask)), -1)
+        np.maximum.accumulate(last, out=last)
+        return np.where(last >= 0, column[np.maximum(last, 0)], initial)
+
+    def _emit(self, after, sub, rows):
+        self._extra.append((after, sub, rows))
+
+    # Handlers that only count or log - nothing to send
+    def _onSystemMessage(self, events, out, mask):
+        return mask
+
+    def _onUnexpectedChannel(self, events, out, mask):
+        return mask
+
+class RolandBatch(BatchRouter):
+    def _updateExpPedal(self, events, out, mask):
+        return mask
+
+    def _scaleBassVelocity(self, events, out, mask):
+        if not self.device.bass_mode:
+            return mask
+        rows = np.flatnonzero(mask)
+        pedal = self._lastValue(self._maskFor("_updateExpPedal"), events["data2"], self.device.exp_pedal_value)[rows]
+        # the same VelocityCurve tables the callback indexes, stacked as (zone, pedal, velocity)
+        tables = []
+        zone_by_note = np.zeros(128, dtype=np.intp)
+        for note, table in enumerate(self.device._curve_by_note):
+            if table is not None:
+                if not any(table is known for known in tables):
+                    tables.append(table)
+                zone_by_note[note] = next(zone for zone, known in enumerate(tables) if known is table)
+        curves = np.array([[list(row) for row in table] for table in tables], dtype=np.int16)
+        out["data2"][rows] = curves[zone_by_note[events["data1"][rows]], pedal, events["data2"][rows]]
+        return mask
+
+class ArturiaBatch(BatchRouter):
+    # Pad presses that start knob sweeps send nothing here - sweeps are timed by the SweepScheduler, so knob turns
+    # are also passed through as if no sweep was running
+    def _onUnexpectedMessage(self, events, out, mask):
+        return mask
+
+    def _onNoteOutOfRange(self, events, out, mask):
+        return mask
+
+    def _onPadPress(self, events, out, mask):
+        return mask
+
+    def _onKnobTurn(self, events, out, mask):
+        return mask
+
+    def _onModWheel(self, events, out, mask):
+        out["data1"][mask] = self.device.KNOB_CC[self.device.target_knob_name]
+        return mask
+
+    def _toggleRotary(self, events, out, mask):
+        rows = np.flatnonzero(mask)
+        turning_on = (np.arange(len(rows)) % 2 == 0) != self.device.rotary_on
+        out["status"][rows] = 0xB0 + self.device.MIDI_CHANNEL_ORGAN - 1
+        out["data1"][rows] = 1
+        out["data2"][rows] = np.where(turning_on, 127, 0)
+        out["size"][rows] = 3
+        return mask
+
+    def _setBasePitch(self, events, out, mask):
+        return mask  # the Note Offs it sends for held notes are worked out by _toggleNote
+
+    def _toggleNote(self, events, out, mask):
+        note_off = 0x80 + self.device.MIDI_CHANNEL - 1
+        data1 = events["data1"].astype(np.int32)
+        base_pitch_events = self._maskFor("_setBasePitch")
+        base_pitch = self._lastValue(base_pitch_events, data1 - MIDI_NOTE_VALUES["C1"], self.device.base_pitch)
+        rows = np.flatnonzero(mask)
+        notes = base_pitch[rows] + 12 * (data1[rows] - MIDI_NOTE_VALUES["C4"])
+        # notes_on is cleared by every base pitch change, so within each stretch between them a key alternates on / off
+        segment = np.cumsum(base_pitch_events)[rows]
+        key = segment * 128 + data1[rows]
+        order = np.argsort(key, kind="stable")
+        sorted_key = key[order]
+        group_start = np.r_[True, sorted_key[1:] != sorted_key[:-1]]
+        group_end = np.r_[group_start[1:], True]
+        position = np.arange(len(rows))
+        rank = position - np.maximum.accumulate(np.where(group_start, position, 0))
+        turning_on = np.empty(len(rows), dtype=bool)
+        turning_on[order] = rank % 2 == 0
+        off_rows = rows[~turning_on]
+        out["data1"][rows] = notes
+        out["status"][off_rows] = note_off
+        out["data2"][off_rows] = 0
+        # Notes still on when the base pitch changes get a Note Off from _sendAllNotesOff, oldest first
+        held = order[group_end & (rank % 2 == 0)]
+        resets = np.flatnonzero(base_pitch_events)
+        closed = held[segment[held] < len(resets)]
+        if len(closed):
+            burst = make_events(len(closed))
+            after = resets[segment[closed]]
+            burst["time"] = events["time"][after]
+            burst["status"] = note_off
+            burst["data1"] = notes[closed]
+            burst["size"] = 3
+            self._emit(after, rows[closed], burst)
+        return mask
+
+BATCH_ROUTERS = {"roland": (Roland, RolandBatch), "arturia": (Arturia, ArturiaBatch)}
+
+def make_device(name, profile, bass_mode=False, midiports=None):
+    # Devices are built on virtual ports so they can be used without the hardware attached
+    if midiports is None:
+        midiports = MidiPorts(VirtualBackend(), writers=False)
+        midiports.open_all_ports()
+    device = BATCH_ROUTERS[name][0](midiports, profile)
+    if name == "roland":
+        device.bass_mode = bass_mode
+    return device
+
+def process_events(name, events, profile=None, bass_mode=False):
+    if profile is None:
+        profile = load_device_profile(DEFAULT_PROFILE)
+    return BATCH_ROUTERS[name][1](make_device(name, profile, bass_mode)).process(events)
+
+def realtime_reference(name, events, profile=None, bass_mode=False):
+    # Feeds events through the realtime callback one at a time and returns what was sent to LoopBe
+    # (pad presses are not allowed to start sweeps, matching the batch path)
+    if profile is None:
+        profile = load_device_profile(DEFAULT_PROFILE)
+    device = make_device(name, profile, bass_mode)
+    if name == "arturia":
+        device._onPadPress = lambda message, msg_channel: None
+        device.update_mappings()  # recompile the rules with the stand-in handler
+    midiout = device.midiports.midiout_loopbe
+    midiout.clear()
+    for message in events_to_messages(events):
+        device._callback((message, 0.0), None)
+    return midiout.messages()
+
+# Standard MIDI File reading / writing (channel messages and meta events - SysEx is dropped like the router does)
+def _readVarLen(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos
+
+def _writeVarLen(value):
+    out = [value & 0x7F]
+    value >>= 7
+    while value:
+        out.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(out))
+
+def read_midi_file(path):
+    # Returns (division, events, meta) - all tracks merged into one event array ordered by time, meta is a list of
+    # (time, meta event bytes) kept so the tempo map etc. can be written back out
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:4] != b"MThd":
+        raise ValueError(f"{path}: not a Standard MIDI File")
+    header_length, file_format, track_count, division = struct.unpack(">IHHH", data[4:14])
+    pos = 8 + header_length
+    columns = ([], [], [], [], [])  # time, status, data1, data2, size
+    meta = []
+    for track in range(track_count):
+        chunk_type, length = struct.unpack(">4sI", data[pos:pos + 8])
+        pos += 8
+        end = pos + length
+        if chunk_type != b"MTrk":
+            pos = end
+            continue
+        now = 0
+        running_status = None
+        while pos < end:
+            delta, pos = _readVarLen(data, pos)
+            now += delta
+            status = data[pos]
+            if status == 0xFF:
+                meta_length, body = _readVarLen(data, pos + 2)
+                if data[pos + 1] != 0x2F:  # end of track is written again on the way out
+                    meta.append((now, data[pos:body + meta_length]))
+                pos = body + meta_length
+                continue
+            if status in (0xF0, 0xF7):
+                sysex_length, pos = _readVarLen(data, pos + 1)
+                pos += sysex_length
+                continue
+            if status < 0x80:
+                status = running_status  # running status - this byte is data1
+            else:
+                pos += 1
+                running_status = status
+            size = 2 if status >> 4 in (0xC, 0xD) else 3
+            columns[0].append(now)
+            columns[1].append(status)
+            columns[2].append(data[pos])
+            columns[3].append(data[pos + 1] if size == 3 else 0)
+            columns[4].append(size)
+            pos += size - 1
+        pos = end
+    events = make_events(len(columns[0]))
+    for name, column in zip(EVENT_DTYPE.names, columns):
+        events[name] = column
+    events = events[np.argsort(events["time"], kind="stable")]
+    meta.sort(key=lambda item: item[0])
+    return division, events, meta
+
+def write_midi_file(path, division, events, meta=()):
+    # Writes a format 0 file - meta events go before channel messages with the same time
+    track = bytearray()
+    now = 0
+    meta = list(meta)
+    next_meta = 0
+    for event_time, status, data1, data2, size in zip(events["time"].tolist(), events["status"].tolist(), events["data1"].tolist(), events["data2"].tolist(), events["size"].tolist()):
+        while next_meta < len(meta) and meta[next_meta][0] <= event_time:
+            track += _writeVarLen(meta[next_meta][0] - now) + meta[next_meta][1]
+            now = meta[next_meta][0]
+            next_meta += 1
+        track += _writeVarLen(event_time - now) + bytes([status, data1, data2][:size])
+        now = event_time
+    for meta_time, body in meta[next_meta:]:
+        track += _writeVarLen(meta_time - now) + body
+        now = meta_time
+    track += b"\x00\xFF\x2F\x00"
+    with open(path, "wb") as f:
+        f.write(b"MThd" + struct.pack(">IHHH", 6, 0, 1, division))
+        f.write(b"MTrk" + struct.pack(">I", len(track)) + bytes(track))
+
+def main():
+    parser = argparse.ArgumentParser(description="Run MIDI files through the router transforms offline")
+    parser.add_argument("--profile", default=DEFAULT_PROFILE, help="device profile (TOML or JSON)")
+    parser.add_argument("--bass-mode", action="store_true", help="turn Roland bass mode on")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name in BATCH_ROUTERS:
+        command = commands.add_parser(name, help=f"process a file as input from the {name} port")
+        command.add_argument("input")
+        command.add_argument("output")
+    verify = commands.add_parser("verify", help="check the batch output against the realtime callbacks")
+    verify.add_argument("device", choices=sorted(BATCH_ROUTERS))
+    verify.add_argument("input")
+    args = parser.parse_args()
+    profile = load_device_profile(args.profile)
+    if args.command == "verify":
+        division, events, meta = read_midi_file(args.input)
+        batch = events_to_messages(process_events(args.device, events, profile, args.bass_mode))
+        realtime = realtime_reference(args.device, events, profile, args.bass_mode)
+        for index, (batch_message, realtime_message) in enumerate(zip(batch, realtime)):
+            if batch_message != realtime_message:
+                print(f"MISMATCH at output message {index}: batch {batch_message} realtime {realtime_message}")
+                sys.exit(1)
+        if len(batch) != len(realtime):
+            print(f"MISMATCH: batch sent {len(batch)} messages, realtime sent {len(realtime)}")
+            sys.exit(1)
+        print(f"OK: {len(events)} events in, {len(batch)} messages out match the realtime callbacks")
+        return
+    division, events, meta = read_midi_file(args.input)
+    started = time.perf_counter()
+    output = process_events(args.command, events, profile, args.bass_mode)
+    elapsed = time.perf_counter() - started
+    write_midi_file(args.output, division, output, meta)
+    print(f"{len(events)} events in, {len(output)} out ({elapsed * 1000:.1f} ms)")
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,437 @@
-import rtmidi, time, threading
+import rtmidi, asyncio, time, threading, collections, heapq, itertools, math, mmap, queue, struct, traceback, json, os, re, signal, sys
 
 # Classes
-class MidiPorts:
+class SystemClock:
+    # Real time for everything in the router that waits or timestamps - the default wherever a clock can be passed in
+    realtime = True  # components run their own threads against this clock
+
+    def monotonic_ns(self):
+        return time.monotonic_ns()
+
+    def time(self):
+        return time.perf_counter()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wake(self):
+        pass  # threaded components wake themselves
+
+class VirtualClock:
+    # Simulated time for deterministic replay: it only moves when advance_to / sleep is called, and while it moves it runs
+    # the work of every registered ticker (SweepScheduler, FeedbackRenderer) in deadline order on the calling thread
+    realtime = False  # components register as tickers instead of starting threads
+
+    def __init__(self, start_ns=0):
+        self.now_ns = start_ns
+        self._tickers = []  # objects with next_deadline_ns() and run_due(now_ns)
+
+    def add_ticker(self, ticker):
+        self._tickers.append(ticker)
+
+    def monotonic_ns(self):
+        return self.now_ns
+
+    def time(self):
+        return self.now_ns / 1e9
+
+    def sleep(self, seconds):
+        self.advance_to(self.now_ns + int(seconds * 1e9))
+
+    def wake(self):
+        pass  # deadlines are looked at every time the clock is advanced
+
+    def advance_to(self, target_ns):
+        while True:
+            due_ticker = None
+            for ticker in self._tickers:  # earliest deadline wins, ties go to the ticker registered first
+                deadline = ticker.next_deadline_ns()
+                if deadline is not None and deadline <= target_ns and (due_ticker is None or deadline < due_deadline):
+                    due_ticker, due_deadline = ticker, deadline
+            if due_ticker is None:
+                break
+            if due_deadline > self.now_ns:
+                self.now_ns = due_deadline
+            due_ticker.run_due(self.now_ns)
+        if target_ns > self.now_ns:
+            self.now_ns = target_ns
+
+    def next_deadline_ns(self):
+        deadlines = [deadline for deadline in (ticker.next_deadline_ns() for ticker in self._tickers) if deadline is not None]
+        return min(deadlines) if deadlines else None
+
+class AsyncioClock:
+    # Real time for the asyncio core (see AsyncCore): like a VirtualClock it runs the registered tickers itself instead
+    # of letting them start threads - run() is one coroutine that sleeps on the event loop until the earliest deadline
+    realtime = False
+    # Loop timers are coarse - epoll waits in whole milliseconds and the Windows Proactor loop in system ticks (about
+    # 15.6 ms) - so wake this much early and yield until the deadline (on Windows that spins the loop for up to a tick
+    # before each sweep step or feedback frame)
+    TIMER_SLACK = 0.016 if sys.platform == "win32" else 0.001
+
     def __init__(self):
-        self.midiin_arturia = rtmidi.MidiIn()
-        self.midiin_roland = rtmidi.MidiIn()
-        self.midiin_loopbe = rtmidi.MidiIn()
-        self.midiout_arturia = rtmidi.MidiOut()
-        self.midiout_roland = rtmidi.MidiOut()
-        self.midiout_loopbe = rtmidi.MidiOut()
+        self._tickers = []
+        self._loop = None
+        self._loop_thread = None
+        self._wakeup = None  # asyncio.Event, made by run() on the loop
+
+    def add_ticker(self, ticker):
+        self._tickers.append(ticker)
+
+    def monotonic_ns(self):
+        return time.monotonic_ns()
+
+    def time(self):
+        return time.perf_counter()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)  # never called on the loop - tickers are not threads here
+
+    def wake(self):
+        # Call after a deadline may have been brought forward from outside a ticker (safe from any thread)
+        loop = self._loop
+        if loop is None:
+            return
+        if threading.get_ident() == self._loop_thread:
+            self._wakeup.set()
+            return
+        try:
+            loop.call_soon_threadsafe(self._wakeup.set)
+        except RuntimeError:
+            pass  # the loop has closed - nothing is waiting on it any more
+
+    def next_deadline_ns(self):
+        deadlines = [deadline for deadline in (ticker.next_deadline_ns() for ticker in self._tickers) if deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._wakeup = asyncio.Event()
+        while True:
+            self._wakeup.clear()
+            now = self.monotonic_ns()
+            for ticker in self._tickers:
+                ticker.run_due(now)
+            deadline = self.next_deadline_ns()
+            if deadline is None:
+                await self._wakeup.wait()
+                continue
+            delay = (deadline - self.monotonic_ns()) / 1e9
+            if delay > self.TIMER_SLACK:
+                timer = self._loop.call_later(delay - self.TIMER_SLACK, self._wakeup.set)
+                await self._wakeup.wait()
+                timer.cancel()
+            elif delay > 0:
+                await asyncio.sleep(0)  # yield to the other callbacks until the deadline
+
+class PollingClock(SystemClock):
+    # Real time for the polling core (see PollingCore): registered tickers are run by the polling thread between polls
+    realtime = False
+
+    def __init__(self):
+        self._tickers = []
+
+    def add_ticker(self, ticker):
+        self._tickers.append(ticker)
+
+    def run_due(self, now):
+        for ticker in self._tickers:
+            ticker.run_due(now)
+
+    def next_deadline_ns(self):
+        deadlines = [deadline for deadline in (ticker.next_deadline_ns() for ticker in self._tickers) if deadline is not None]
+        return min(deadlines) if deadlines else None
+
+class RtMidiBackend:
+    # Hardware (and OS virtual) ports through python-rtmidi
+    def midi_in(self):
+        return rtmidi.MidiIn()
+
+    def midi_out(self):
+        return rtmidi.MidiOut()
+
+class VirtualMidiIn:
+    # In-process stand-in for rtmidi.MidiIn - messages are pushed in with inject()
+    def __init__(self, backend):
+        self.backend = backend
+        self.port_name = None
+        self._callback = None
+        self._callback_data = None
+        self._pending = queue.Queue()  # (message, delta_time) waiting for the delivery thread or get_message()
+        self._thread = None
+        self._last_timestamp = None
+
+    def get_ports(self):
+        return list(self.backend.port_names)
+
+    def get_port_count(self):
+        return len(self.backend.port_names)
+
+    def get_port_name(self, index):
+        return self.backend.port_names[index]
+
+    def open_port(self, index=0):
+        self.port_name = self.backend.port_names[index]
+
+    def close_port(self):
+        self.port_name = None
+
+    def is_port_open(self):
+        return self.port_name is not None
+
+    def ignore_types(self, sysex=True, timing=True, active_sense=True):
+        pass
+
+    def set_callback(self, func, data=None):
+        self._callback = func
+        self._callback_data = data
+        if self.backend.threaded and self._thread is None:
+            self._thread = threading.Thread(target=self._deliver, name="VirtualMidiIn", daemon=True)
+            self._thread.start()
+
+    def cancel_callback(self):
+        self._callback = None
+
+    def get_message(self):
+        # Polling interface (only used while no callback is set) - returns (message, delta_time) like rtmidi
+        try:
+            event = self._pending.get_nowait()
+        except queue.Empty:
+            return None
+        self._pending.task_done()
+        return event
+
+    def inject(self, message, timestamp=None):
+        # Feeds one message into the port as if it had arrived from the device at timestamp (backend clock seconds)
+        # delta_time is worked out from the previous injected timestamp in the same way rtmidi reports it
+        if timestamp is None:
+            timestamp = self.backend.clock()
+        delta_time = 0.0 if self._last_timestamp is None else timestamp - self._last_timestamp
+        self._last_timestamp = timestamp
+        event = (list(message), delta_time)
+        if self._callback is not None and not self.backend.threaded:
+            self._callback(event, self._callback_data)
+        else:
+            self._pending.put(event)
+
+    def wait_idle(self):
+        # Blocks until the delivery thread has handed every injected message to the callback
+        self._pending.join()
+
+    def _deliver(self):
+        while True:
+            event = self._pending.get()
+            try:
+                if self._callback is not None:
+                    self._callback(event, self._callback_data)
+            except Exception:
+                traceback.print_exc()  # like rtmidi, report the error and keep delivering
+            finally:
+                self._pending.task_done()
+
+class VirtualMidiOut:
+    # In-process stand-in for rtmidi.MidiOut that captures everything sent to it
+    def __init__(self, backend):
+        self.backend = backend
+        self.port_name = None
+        self.sent = []  # (timestamp, message) when the backend captures, otherwise left empty
+        self.count = 0
+
+    def get_ports(self):
+        return list(self.backend.port_names)
+
+    def get_port_count(self):
+        return len(self.backend.port_names)
+
+    def get_port_name(self, index):
+        return self.backend.port_names[index]
+
+    def open_port(self, index=0):
+        self.port_name = self.backend.port_names[index]
+
+    def close_port(self):
+        self.port_name = None
+
+    def is_port_open(self):
+        return self.port_name is not None
+
+    def send_message(self, message):
+        self.count += 1
+        if self.backend.capture:
+            self.sent.append((self.backend.clock(), list(message)))
+
+    def messages(self):
+        return [message for timestamp, message in self.sent]
+
+    def clear(self):
+        self.sent.clear()
+        self.count = 0
+
+class VirtualBackend:
+    # Hardware-free ports for benchmarking and testing the routing logic
+    # threaded=True delivers input on a per-port thread like rtmidi does, otherwise inject() calls the callback directly
+    PORT_NAMES = ("Arturia MiniLab mkII", "UMC404HD 192k MIDI", "LoopBe Internal MIDI 1")
+
+    def __init__(self, port_names=PORT_NAMES, threaded=False, capture=True, clock=time.perf_counter):
+        self.port_names = list(port_names)
+        self.threaded = threaded
+        self.capture = capture  # set False to only count output messages
+        self.clock = clock
+
+    def midi_in(self):
+        return VirtualMidiIn(self)
+
+    def midi_out(self):
+        return VirtualMidiOut(self)
+
+class MidiPorts:
+    def __init__(self, backend=None, port_cache=None, writers=True, stats=None, clock=None):
+        # writers=True (the default) puts an OutputScheduler in front of every output port so each port has exactly one
+        # writer thread - midiout_<device>.port is the port itself
+        # clock (SystemClock unless given) is used by everything built on these ports that waits or timestamps
+        self.backend = backend if backend is not None else RtMidiBackend()
+        self.clock = clock if clock is not None else SystemClock()
+        self.resolver = PortResolver(port_cache)
+        self.midiin_arturia = self.backend.midi_in()
+        self.midiin_roland = self.backend.midi_in()
+        self.midiin_loopbe = self.backend.midi_in()
+        self.midiout_arturia = self.backend.midi_out()
+        self.midiout_roland = self.backend.midi_out()
+        self.midiout_loopbe = self.backend.midi_out()
+        if writers:
+            stats = stats if stats is not None else router_stats
+            for attribute in ("midiout_arturia", "midiout_roland", "midiout_loopbe"):
+                setattr(self, attribute, OutputScheduler(getattr(self, attribute), stats=stats.output(attribute), clock=self.clock))
+        self.port_specs = {}  # device -> PortSpec used by the last open_all_ports
+        self.directions = ()  # "in" / "out" - the directions open_all_ports opened (and check_ports watches)
+        self.connected = {}  # port attribute (e.g. "midiin_arturia") -> name of the open port, None while it is missing
+        self.callbacks = {}  # input port attribute -> (func, data) to reattach after a reconnect
+        self.capture = None  # InputCapture that every input event is also written to (see start_capture)
+        self.latency = None  # input port attribute -> LatencyStats while start_latency_tracking is in effect
+        self._latency_tags = threading.local()  # .origin = (LatencyStats, arrival ns) while a tracked callback runs
+        self.handoff = None  # AsyncCore while input callbacks are handed off to its event loop
+        self.poller = None  # PollingCore while the input ports are drained with get_message instead of callbacks
+        self._port_counts = {"in": None, "out": None}
+        self._reconnect_listeners = []
+
+    def set_callback(self, device, func, data=None):
+        # Use this rather than midiin_<device>.set_callback so the callback survives the port being unplugged
+        # (and is captured while start_capture is in effect)
+        self.callbacks["midiin_" + device] = (func, data)
+        self._attach("midiin_" + device, func, data)
+
+    def start_capture(self, path, flush_interval=1.0):
+        # Records every event arriving on a port with a callback into an InputCapture file until stop_capture
+        self.capture = InputCapture(path, flush_interval)
+        self._reattachCallbacks()
+        return self.capture
+
+    def stop_capture(self):
+        capture, self.capture = self.capture, None
+        self._reattachCallbacks()
+        if capture is not None:
+            capture.close()
+        return capture
+
+    def start_latency_tracking(self, stats=None):
+        # Records where each input port's messages spend their time (see LatencyStats) until stop_latency_tracking
+        # Messages sent while a tracked callback runs are tagged with the input's arrival time so the output writers
+        # can record arrival -> written to the port (only with writers=True)
+        stats = stats if stats is not None else router_stats
+        self.latency = {attribute: stats.input_latency(attribute) for attribute in ("midiin_arturia", "midiin_roland", "midiin_loopbe")}
+        for attribute in ("midiout_arturia", "midiout_roland", "midiout_loopbe"):
+            if isinstance(getattr(self, attribute), OutputScheduler):
+                getattr(self, attribute).tags = self._latency_tags
+        self._reattachCallbacks()
+        return self.latency
+
+    def stop_latency_tracking(self):
+        latency, self.latency = self.latency, None
+        for attribute in ("midiout_arturia", "midiout_roland", "midiout_loopbe"):
+            if isinstance(getattr(self, attribute), OutputScheduler):
+                getattr(self, attribute).tags = None
+        self._reattachCallbacks()
+        return latency
+
+    def _reattachCallbacks(self):
+        for attribute, (func, data) in self.callbacks.items():
+            self._attach(attribute, func, data)
+
+    def _attach(self, attribute, func, data):
+        if self.poller is not None:
+            self.poller.attach(attribute, getattr(self, attribute), self._wrapCallback(attribute, func), data)  # no port callback - get_message only works without one
+            return
+        getattr(self, attribute).set_callback(self._wrapCallback(attribute, func), data)
+
+    def _wrapCallback(self, attribute, func):
+        # Without a capture or latency tracking the device callback is used as it is, so both cost nothing while off
+        if self.capture is not None:
+            func = self._captureCallback(attribute, func)
+        if self.latency is not None:
+            return self._trackLatency(attribute, self.latency[attribute], func)  # does the handoff itself
+        if self.handoff is not None:
+            func = self.handoff.wrap(attribute, func)
+        return func
+
+    def _captureCallback(self, attribute, func):
+        record = self.capture.record
+        port_id = CAPTURE_PORT_IDS[attribute]
+        def captured(msg, data):
+            record(port_id, msg)
+            func(msg, data)
+        return captured
+
+    def _trackLatency(self, attribute, stats, func):
+        # The arrival is stamped by the outermost wrapper - on the thread the driver calls, before any handoff to the
+        # asyncio core - so queue time is the driver's alone in every core; python is the callback itself wherever it
+        # runs (the wait for the event loop in between only shows up in the output time)
+        stats.restart()  # a new (or reopened) port starts its delta times again
+        clock = self.clock.monotonic_ns
+        tags = self._latency_tags
+        def route(msg, data, arrival):
+            started = time.perf_counter_ns()
+            tags.origin = (stats, arrival)
+            try:
+                func(msg, data)
+            finally:
+                tags.origin = None
+                stats.python.record(time.perf_counter_ns() - started)
+        if self.handoff is None:
+            def tracked(msg, data):
+                route(msg, data, stats.arrival(msg[1], clock()))
+            return tracked
+        handoff = self.handoff.wrap(attribute, lambda stamped, data: route(stamped[0], data, stamped[1]))
+        def tracked(msg, data):
+            handoff((msg, stats.arrival(msg[1], clock())), data)
+        return tracked
+
+    def add_reconnect_listener(self, func):
+        # func(device, direction) is called from the PortWatcher thread after a port has been reopened
+        self._reconnect_listeners.append(func)
+
+    def set_output_budgets(self, bytes_per_second):
+        # bytes_per_second maps device -> budget for its OutputScheduler (0 / None = no limit)
+        for device, budget in bytes_per_second.items():
+            midiout = getattr(self, "midiout_" + device)
+            if isinstance(midiout, OutputScheduler):
+                midiout.set_budget(budget)
+
+    def wait_outputs_idle(self, timeout=None):
+        # Blocks until every output writer has sent what it has been given (and any handed off or polled input has been routed)
+        for core in (self.handoff, self.poller):
+            if core is not None and not core.wait_idle(timeout):
+                return False
+        for attribute in ("midiout_arturia", "midiout_roland", "midiout_loopbe"):
+            midiout = getattr(self, attribute)
+            if isinstance(midiout, OutputScheduler) and not midiout.wait_idle(timeout):
+                return False
+        return True
 
     def close_all_ports(self):
+        for attribute in ("midiout_arturia", "midiout_roland", "midiout_loopbe"):
+            if isinstance(getattr(self, attribute), OutputScheduler):
+                getattr(self, attribute).close()
         del self.midiin_arturia
         del self.midiin_roland
         del self.midiin_loopbe
@@ -18,269 +439,1954 @@ class MidiPorts:
         del self.midiout_roland
         del self.midiout_loopbe
 
-    def open_all_ports(self):
-        # in ports
-        if not self._open_midi_in_port(self.midiin_arturia, "arturia"): print("MIDI PORT ERROR: unable to open Arturia In Port")
-        if not self._open_midi_in_port(self.midiin_roland, "umc"): print("MIDI PORT ERROR: unable to open Roland In Port")
-        if not self._open_midi_in_port(self.midiin_loopbe, "loopbe internal midi 1"): print("MIDI PORT ERROR: unable to open LoopBe In Port")
-        # out ports
-        if not self._open_midi_out_port(self.midiout_arturia, "arturia"): print("MIDI PORT ERROR: unable to open Arturia Out Port")
-        if not self._open_midi_out_port(self.midiout_roland, "umc"): print("MIDI PORT ERROR: unable to open Roland Out Port")
-        if not self._open_midi_out_port(self.midiout_loopbe, "loopbe internal midi 1"): print("MIDI PORT ERROR: unable to open LoopBe Out Port")
-
-    def _open_midi_in_port(self, midiin, name):
-        ports = midiin.get_ports()
-        for i in range(len(ports)):
-            if name.lower() in ports[i].lower():
-                midiin.open_port(i)
-                return True
-        return False
+    def open_all_ports(self, port_names=None, directions=("in", "out")):
+        # port_names maps "arturia" / "roland" / "loopbe" to a PortSpec or a substring of the port name (see DeviceProfile.port_names)
+        # - only the devices it names are opened, and only in the given directions (a shard worker opens just its input)
+        # Each direction is enumerated at most once - and not at all when every cached port is still where it was
+        if port_names is None:
+            port_names = DEFAULT_PORT_NAMES
+        specs = {device: as_port_spec(spec) for device, spec in port_names.items()}
+        self.port_specs = specs
+        self.directions = tuple(directions)
+        for direction in self.directions:
+            resolved = self.resolver.resolve(self.midiin_arturia if direction == "in" else self.midiout_arturia, direction, specs)
+            for device in specs:
+                attribute = "midi" + direction + "_" + device
+                self.connected[attribute] = resolved[device][1] if resolved[device] else None
+                if not self._open_port(getattr(self, attribute), resolved[device]):
+                    print(f"MIDI PORT ERROR: unable to open {PORT_LABELS[device]} {direction.capitalize()} Port")
+
+    def _open_port(self, midi_port, resolved):
+        # resolved is the (index, name) pair from PortResolver.resolve, or None if no port matched
+        if resolved is None:
+            return False
+        midi_port.open_port(resolved[0])
+        return True
+
+    def check_ports(self):
+        # Called by PortWatcher: closes ports whose device has gone and reopens them when it comes back
+        # A direction is only enumerated when its port count has changed or one of its ports is missing
+        # Returns True if any port was lost or reconnected
+        changed = False
+        for direction in self.directions:
+            probe = self.midiin_arturia if direction == "in" else self.midiout_arturia
+            prefix = "midi" + direction + "_"
+            count = probe.get_port_count()
+            missing = [device for device in self.port_specs if self.connected.get(prefix + device) is None]
+            if count == self._port_counts[direction] and not missing:
+                continue
+            self._port_counts[direction] = count
+            port_names = probe.get_ports()
+            for device in self.port_specs:
+                attribute = prefix + device
+                if self.connected.get(attribute) is not None and self.connected[attribute] not in port_names:
+                    print(f"MIDI PORT WARNING: {PORT_LABELS[device]} {direction.capitalize()} Port disconnected")
+                    getattr(self, attribute).close_port()
+                    self.connected[attribute] = None
+                    missing.append(device)
+                    changed = True
+            if not missing:
+                continue
+            resolved = self.resolver.resolve(probe, direction, {device: self.port_specs[device] for device in missing}, port_names)
+            for device in missing:
+                if resolved[device] is not None:
+                    self._reconnect(device, direction, resolved[device])
+                    changed = True
+        return changed
+
+    def _reconnect(self, device, direction, resolved):
+        attribute = "midi" + direction + "_" + device
+        midi_port = getattr(self, attribute)
+        self._open_port(midi_port, resolved)
+        self.connected[attribute] = resolved[1]
+        if attribute in self.callbacks:
+            func, data = self.callbacks[attribute]
+            self._attach(attribute, func, data)
+        print(f"MIDI PORT: {PORT_LABELS[device]} {direction.capitalize()} Port reconnected ({resolved[1]})")
+        for listener in self._reconnect_listeners:
+            listener(device, direction)
+
+class PortWatcher:
+    # Background thread that notices ports disappearing / reappearing (see MidiPorts.check_ports)
+    # The polling interval doubles up to max_interval while nothing changes and drops back to min_interval after a change,
+    # so an idle rig costs one get_port_count() per direction every few seconds - a device that is missing (unplugged, or
+    # simply not part of this rig) is looked for at the same backed-off rate
+    def __init__(self, midiports, min_interval=0.5, max_interval=8.0):
+        self.midiports = midiports
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.polls = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="PortWatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def poll(self):
+        self.polls += 1
+        try:
+            changed = self.midiports.check_ports()
+        except Exception:
+            traceback.print_exc()  # keep watching - the backend can fail while a device is half-plugged
+            changed = True
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.poll()
+
+class OutputScheduler:
+    # The only writer of one output port: send_message() from any thread (input callbacks, sweeps, the renderer) only
+    # appends to a bounded inbox and the scheduler's own thread does every port.send_message. Channel messages (notes,
+    # CCs, program changes, pitch bend...) are written in the order they arrived; SysEx (the Arturia feedback) waits
+    # behind them, so a burst of feedback never holds up a Note On
+    # bytes_per_second paces the port (3125 for a 5-pin DIN cable, None for no limit). Only while the budget is holding
+    # the port back do notes go ahead of the other channel messages, a newer CC / pitch bend / pressure / program change
+    # replaces the waiting one for the same controller and SysEx for the same parameter is coalesced too (latest value
+    # wins); beyond max_sysex_pending the oldest SysEx is dropped
+    # Notes are never coalesced. A full inbox (or note queue) drops the new message and counts an overflow rather than
+    # making the producer wait - except a Note Off, which is always queued so an overflow can never leave a note stuck
+    # Other attributes are passed through to the wrapped port
+    # While tags is set (MidiPorts.start_latency_tracking) each message carries the origin of the input that caused it
+    # and the input port's LatencyStats.output records arrival -> written once it has been sent
+    NOTES = 0
+    CHANNEL = 1
+    SYSEX = 2
+    CLASS_NAMES = ("notes", "channel", "sysex")
+
+    def __init__(self, port, bytes_per_second=None, stats=None, max_pending=1024, max_sysex_pending=256, clock=None):
+        self.port = port
+        self.clock = clock if clock is not None else SystemClock()  # must be realtime - the writer is a thread
+        self.bytes_per_second = bytes_per_second or None
+        self.stats = stats if stats is not None else OutputStats()
+        self.stats.schedulers.append(self)
+        self.max_pending = max_pending
+        self.max_sysex_pending = max_sysex_pending
+        self.tags = None  # threading.local whose .origin is (LatencyStats, arrival ns) or None
+        self._inbox = collections.deque()  # (message, enqueued ns, origin) - deque appends / pops are atomic so producers take no lock
+        # Everything below is only touched by the scheduler thread
+        self._notes = collections.deque()  # (message, enqueued ns, origin, sequence)
+        self._channel = collections.deque()  # [key, message, enqueued ns, origin, sequence] entries
+        self._channel_latest = {}  # key -> its newest entry still in self._channel (the one coalescing updates)
+        self._sysex = collections.deque()
+        self._sysex_latest = {}
+        self._next_send = 0  # earliest monotonic_ns the budget allows the next message
+        self._throttled = False  # the budget has held the port back since the queues were last empty
+        self._sequence = 0  # arrival order, so notes and the other channel messages can be merged back in order
+        self._busy = False
+        self._idle = False  # True while the thread is asleep waiting for the inbox
+        self._closing = False
+        self._wakeup = threading.Event()
+        self._start()
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name="OutputScheduler", daemon=True)
+        self._thread.start()
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    def send_message(self, message):
+        if len(self._inbox) >= self.max_pending and not is_note_off(message):
+            self.stats.overflows += 1
+            return
+        self._inbox.append((message, self.clock.monotonic_ns(), None if self.tags is None else getattr(self.tags, "origin", None)))
+        if self._idle:
+            self._wakeup.set()
+
+    def pending(self):
+        # Approximate when read from another thread
+        return len(self._inbox) + len(self._notes) + len(self._channel) + len(self._sysex)
+
+    def wait_idle(self, timeout=None):
+        # Blocks until everything sent so far has been written to the port (or timeout seconds pass)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._busy or self.pending():
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.0005)
+        return True
+
+    def set_budget(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second or None
+
+    def close(self, timeout=1.0):
+        # Sends what is still waiting (up to timeout) and stops the thread
+        self._closing = True
+        self._wakeup.set()
+        self._thread.join(timeout)
+
+    def _drain(self):
+        # Moves everything in the inbox into the queues, coalescing as it goes while the budget is holding the port back
+        inbox = self._inbox
+        coalesce = self._throttled
+        while inbox:
+            message, enqueued, origin = inbox.popleft()
+            self._sequence += 1
+            msg_type = message[0] >> 4
+            if msg_type == NOTE_ON or msg_type == NOTE_OFF:
+                if len(self._notes) >= self.max_pending and not is_note_off(message):
+                    self.stats.overflows += 1
+                    continue
+                self._notes.append((message, enqueued, origin, self._sequence))
+            elif msg_type != SYSTEM_MESSAGE:
+                key = (message[0], message[1]) if msg_type in (CONTROL_CHANGE, POLY_PRESSURE) else message[0]
+                self._enqueue(self._channel, self._channel_latest, self.CHANNEL, key, message, enqueued, origin, coalesce)
+            else:
+                key = (len(message),) + tuple(message[:-2])  # everything but the value and the closing F7
+                self._enqueue(self._sysex, self._sysex_latest, self.SYSEX, key, message, enqueued, origin, coalesce)
+                if len(self._sysex) > self.max_sysex_pending:
+                    self._popFrom(self._sysex, self._sysex_latest)
+                    self.stats.dropped[self.SYSEX] += 1
+        depth = len(self._notes) + len(self._channel) + len(self._sysex)
+        if depth > self.stats.max_depth:
+            self.stats.max_depth = depth
+        return depth
+
+    def _enqueue(self, queue, latest, priority, key, message, enqueued, origin, coalesce):
+        waiting = latest.get(key)
+        if coalesce and waiting is not None:
+            waiting[1] = message  # keeps its place in the queue and its original wait
+            waiting[3] = origin
+            self.stats.coalesced[priority] += 1
+            return
+        entry = [key, message, enqueued, origin, self._sequence]
+        queue.append(entry)
+        latest[key] = entry
+
+    def _popFrom(self, queue, latest):
+        entry = queue.popleft()
+        if latest.get(entry[0]) is entry:
+            del latest[entry[0]]
+        return entry[1], entry[2], entry[3]
+
+    def _popNext(self):
+        # Oldest channel message first (notes first while throttled), SysEx once no channel message is waiting
+        notes, channel = self._notes, self._channel
+        if notes and (self._throttled or not channel or notes[0][3] < channel[0][4]):
+            message, enqueued, origin, sequence = notes.popleft()
+            return self.NOTES, (message, enqueued, origin)
+        if self._channel:
+            return self.CHANNEL, self._popFrom(self._channel, self._channel_latest)
+        return self.SYSEX, self._popFrom(self._sysex, self._sysex_latest)
+
+    def _run(self):
+        while True:
+            self._busy = True
+            if not self._drain():
+                self._busy = False
+                self._throttled = False
+                if self._closing:
+                    return
+                self._idle = True
+                self._wakeup.clear()
+                if not self._inbox:
+                    self._wakeup.wait()
+                self._idle = False
+                continue
+            now = self.clock.monotonic_ns()
+            if self._next_send > now:
+                self._throttled = True
+                self.clock.sleep((self._next_send - now) / 1e9)
+                continue  # pick up anything more urgent that arrived meanwhile
+            priority, (message, enqueued, origin) = self._popNext()
+            self._write(priority, message, enqueued, origin)
+
+    def _write(self, priority, message, enqueued, origin):
+        try:
+            self.port.send_message(message)
+        except Exception:
+            self.stats.errors += 1  # e.g. the device was unplugged - PortWatcher reopens the port
+            return
+        sent = self.clock.monotonic_ns()
+        self.stats.sent[priority] += 1
+        self.stats.wait[priority].record(sent - enqueued)
+        if origin is not None:
+            origin[0].output.record(sent - origin[1])
+        if self.bytes_per_second:
+            self._next_send = max(self._next_send, sent - 1000000) + len(message) * 1000000000 // self.bytes_per_second  # up to 1 ms of unused budget carries over
+
+class AsyncOutputScheduler(OutputScheduler):
+    # OutputScheduler whose writer is a coroutine on the asyncio core's event loop instead of a thread - the same
+    # ordering, pacing and coalescing. send_message must be called on the loop (in the asyncio core the device
+    # callbacks, sweeps and the feedback renderer all are); other coroutines can await send() and drain()
+    def _start(self):
+        self._wakeup = asyncio.Event()  # the writer task is started by AsyncCore.run
+
+    async def run(self):
+        while True:
+            self._busy = True
+            if not self._drain():
+                self._busy = False
+                self._throttled = False
+                if self._closing:
+                    return
+                self._idle = True
+                self._wakeup.clear()
+                if not self._inbox:
+                    await self._wakeup.wait()
+                self._idle = False
+                continue
+            now = self.clock.monotonic_ns()
+            if self._next_send > now:
+                self._throttled = True
+                await asyncio.sleep((self._next_send - now) / 1e9)
+                continue
+            priority, (message, enqueued, origin) = self._popNext()
+            self._write(priority, message, enqueued, origin)
+
+    async def send(self, message):
+        # Like send_message, but waits while the inbox is full instead of dropping the message
+        while len(self._inbox) >= self.max_pending:
+            await asyncio.sleep(0)  # the writer empties the inbox every time it runs
+        self.send_message(message)
+
+    async def drain(self):
+        # Waits until everything sent so far has been written to the port
+        while self._busy or self.pending():
+            await asyncio.sleep(0.0005)
+
+    def close(self, timeout=1.0):
+        # The writer task finishes once the inbox is empty (AsyncCore.run waits for it)
+        self._closing = True
+        if self._idle:
+            self._wakeup.set()
+
+class AsyncCore:
+    # asyncio alternative to the thread model (ASYNC_CORE): rtmidi's threads only append each input event to a deque and
+    # the device callbacks, sweep steps, feedback frames and output writers all run on one event loop, so routing state
+    # is only touched by the loop thread
+    # Handoff costs one loop.call_soon_threadsafe per batch - events arriving while a batch is waiting join it
+    def __init__(self, backend=None, port_cache=None, writers=True, stats=None):
+        # writers=False sends straight from the callbacks on the loop (no AsyncOutputScheduler)
+        stats = stats if stats is not None else router_stats
+        self.clock = AsyncioClock()
+        self.midiports = MidiPorts(backend, port_cache, writers=False, clock=self.clock)
+        self.midiports.handoff = self
+        self.writers = []
+        for attribute in ("midiout_arturia", "midiout_roland", "midiout_loopbe") if writers else ():
+            writer = AsyncOutputScheduler(getattr(self.midiports, attribute), stats=stats.output(attribute), clock=self.clock)
+            setattr(self.midiports, attribute, writer)
+            self.writers.append(writer)
+        self.loop = None
+        self.running = threading.Event()  # set once run() has started the writers
+        self.batches = 0  # handoffs to the loop
+        self.messages = 0  # input events delivered in them
+        self._pending = collections.deque()  # (func, msg, data) waiting for the loop
+        self._scheduled = False  # a batch is queued on the loop
+        self._routing = False  # a batch is running
+        self._stopping = None
+
+    def wrap(self, attribute, func):
+        # The callback rtmidi's thread calls for one input port: queue the event and make sure a batch is scheduled
+        pending = self._pending
+        def handoff(msg, data):
+            pending.append((func, msg, data))
+            loop = self.loop
+            if not self._scheduled and loop is not None:
+                self._scheduled = True
+                try:
+                    loop.call_soon_threadsafe(self._runBatch)
+                except RuntimeError:
+                    pass  # the loop closed as run() finished - the event waits for the next run()
+        return handoff
+
+    def wait_idle(self, timeout=None):
+        # Blocks until every event handed to the loop so far has been routed (not to be called on the loop)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._pending or self._routing:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.0005)
+        return True
+
+    def _runBatch(self):
+        # Cleared before draining: an event appended after the last popleft schedules the next batch itself
+        self._scheduled = False
+        self._routing = True
+        pending = self._pending
+        self.batches += 1
+        while pending:
+            func, msg, data = pending.popleft()
+            self.messages += 1
+            try:
+                func(msg, data)
+            except Exception:
+                traceback.print_exc()  # like rtmidi, report the error and keep delivering
+        self._routing = False
+        self.clock.wake()  # the batch may have started sweeps or queued feedback
+
+    async def run(self):
+        # Routes until stop() - open the ports and set the device callbacks first
+        self.loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        writer_tasks = [asyncio.create_task(writer.run()) for writer in self.writers]
+        clock_task = asyncio.create_task(self.clock.run())
+        self._scheduled = True
+        self.loop.call_soon(self._runBatch)  # anything that arrived before the loop was running
+        self.running.set()
+        try:
+            await self._stopping.wait()
+        finally:
+            self.loop = None  # from now on input events only queue up (for the next run) instead of being handed to this loop
+            clock_task.cancel()
+            for writer in self.writers:
+                writer.close()
+            if writer_tasks:
+                await asyncio.wait(writer_tasks, timeout=1.0)
+            self.running.clear()
+
+    async def run_until_input(self, prompt):
+        # The asyncio version of main's blocking input(): stdin is read on an executor thread
+        task = asyncio.create_task(self.run())
+        await asyncio.get_running_loop().run_in_executor(None, input, prompt)
+        self.stop()
+        await task
+
+    def start_thread(self):
+        # Runs the loop on a thread of its own and returns once it is routing (for driving the core from synchronous code)
+        thread = threading.Thread(target=asyncio.run, args=(self.run(),), name="AsyncCore", daemon=True)
+        thread.start()
+        self.running.wait()
+        return thread
+
+    def stop(self):
+        # Safe from any thread (a no-op once run() has finished)
+        loop = self.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._stopping.set)
+
+class PollingCore:
+    # Alternative to the rtmidi callback threads (POLLING_INPUT): one thread drains every input port with get_message()
+    # and also runs the sweep steps and feedback frames, so routing state is only ever touched by that thread
+    # After a pass that found messages it polls again straight away; while idle the sleep doubles from min_sleep up to
+    # max_sleep, and never runs past the next sweep step or feedback frame
+    def __init__(self, backend=None, port_cache=None, writers=True, stats=None, min_sleep=0.0001, max_sleep=0.002):
+        self.clock = PollingClock()
+        self.midiports = MidiPorts(backend, port_cache, writers, stats, self.clock)
+        self.midiports.poller = self
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.polls = 0  # passes over the input ports
+        self.sleeps = 0
+        self.messages = 0
+        self._routes = {}  # input port attribute -> (port, wrapped callback, data)
+        self._ports = ()  # the same, as the tuple each pass iterates
+        self._idle = False  # the last pass found nothing
+        self._stop = threading.Event()
+        self._thread = None
+
+    def attach(self, attribute, port, callback, data):
+        self._routes[attribute] = (port, callback, data)
+        self._ports = tuple(self._routes.values())
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="PollingCore", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def wait_idle(self, timeout=None):
+        # Blocks until a pass that began after the call has found every port empty
+        deadline = None if timeout is None else time.monotonic() + timeout
+        polls = self.polls
+        while self.polls < polls + 2 or not self._idle:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.0005)
+        return True
+
+    def _run(self):
+        clock = self.clock
+        sleep = self.min_sleep
+        while not self._stop.is_set():
+            clock.run_due(clock.monotonic_ns())
+            received = 0
+            for port, callback, data in self._ports:
+                msg = port.get_message()
+                while msg is not None:
+                    received += 1
+                    try:
+                        callback(msg, data)
+                    except Exception:
+                        traceback.print_exc()  # like rtmidi, report the error and keep delivering
+                    msg = port.get_message()
+            self.polls += 1
+            if received:
+                self.messages += received
+                self._idle = False
+                sleep = self.min_sleep
+                continue
+            self._idle = True
+            deadline = clock.next_deadline_ns()
+            delay = sleep if deadline is None else min(sleep, (deadline - clock.monotonic_ns()) / 1e9)
+            if delay > 0:
+                self.sleeps += 1
+                time.sleep(delay)
+            sleep = min(sleep * 2, self.max_sleep)
+
+class PortSpec:
+    # How to find a MIDI port by name: "substring" (case-insensitive, the default), "exact" or "regex" (case-insensitive search)
+    MATCH_MODES = ("substring", "exact", "regex")
+
+    def __init__(self, pattern, match="substring"):
+        if match not in self.MATCH_MODES:
+            raise ValueError(f"unknown port match mode {match!r} (expected one of {', '.join(self.MATCH_MODES)})")
+        self.pattern = pattern
+        self.match = match
+        self._lower_pattern = pattern.lower()
+        self._regex = re.compile(pattern, re.IGNORECASE) if match == "regex" else None
+
+    def matches(self, port_name):
+        if self.match == "exact":
+            return port_name == self.pattern
+        if self.match == "regex":
+            return self._regex.search(port_name) is not None
+        return self._lower_pattern in port_name.lower()
+
+    def key(self):
+        return f"{self.match}:{self.pattern}"
+
+class PortResolver:
+    # Resolves several PortSpecs with a single get_ports() enumeration and caches the resolved name -> index mapping
+    # A cached entry is trusted (and the scan skipped) while get_port_name(index) still returns the cached name
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path  # JSON file so restarts can skip the scan too (None keeps the cache in memory only)
+        self.scans = 0  # full enumerations done so far
+        self.ambiguous = {}  # "direction|spec" -> every port name the spec matched, when it matched more than one
+        self._cache = {}  # "direction|spec" -> [index, name]
+        if cache_path and os.path.exists(cache_path):
+            try:
+                with open(cache_path) as f:
+                    self._cache = json.load(f)
+            except (OSError, ValueError):
+                self._cache = {}
+
+    def resolve(self, midi_port, direction, specs, port_names=None):
+        # specs maps a device key to a PortSpec - returns device key -> (index, name), or None where nothing matched
+        # port_names can be passed in when the caller has just enumerated the ports itself
+        resolved = {}
+        for device, spec in specs.items():
+            cached = self._cache.get(direction + "|" + spec.key())
+            if cached is not None and self._portName(midi_port, cached[0]) == cached[1]:
+                resolved[device] = tuple(cached)
+        if len(resolved) == len(specs):
+            return resolved
+        if port_names is None:
+            port_names = midi_port.get_ports()
+            self.scans += 1
+        for device, spec in specs.items():
+            if device in resolved:
+                continue
+            matches = [(index, name) for index, name in enumerate(port_names) if spec.matches(name)]
+            cache_key = direction + "|" + spec.key()
+            if len(matches) > 1:
+                self.ambiguous[cache_key] = [name for index, name in matches]
+                print(f"MIDI PORT WARNING: {spec.pattern!r} matches {len(matches)} {direction} ports ({', '.join(self.ambiguous[cache_key])}) - using {matches[0][1]!r}")
+            if matches:
+                resolved[device] = matches[0]
+                self._cache[cache_key] = list(matches[0])
+            else:
+                resolved[device] = None
+                self._cache.pop(cache_key, None)
+        self._save()
+        return resolved
+
+    def forget(self):
+        self._cache = {}
+        self._save()
+
+    def _portName(self, midi_port, index):
+        try:
+            return midi_port.get_port_name(index)
+        except Exception:  # rtmidi raises for indexes that no longer exist
+            return None
+
+    def _save(self):
+        if not self.cache_path:
+            return
+        try:
+            with open(self.cache_path, "w") as f:
+                json.dump(self._cache, f, indent=2)
+        except OSError:
+            pass  # the cache is only an optimisation
+
+class Sweep:
+    # State of one knob transition - advanced a step at a time by SweepScheduler
+    # The sweep object is also its cancellation handle: pass it to SweepScheduler.cancel
+    # Deadlines are absolute time.monotonic_ns times from when the sweep starts, so time spent sending does not add up,
+    # and the timing of every step actually run is recorded for jitter / end error
+    # mode "steps": `steps` evenly spaced values, step n due period * (n - 1) after the start
+    # mode "values": one step per distinct integer value between initial and target, each due when a straight line
+    # over the same (steps - 1) * period duration reaches it - only real value changes are sent (none at all when the knob
+    # is already at the target: the sweep finishes as soon as it is started)
+    MODES = ("steps", "values")
+
+    def __init__(self, knob_name, pad_name, initial_value, target_value, steps, period, on_step, on_finish, mode="steps"):
+        if mode not in self.MODES:
+            raise ValueError(f"unknown sweep mode {mode!r} (expected one of {', '.join(self.MODES)})")
+        self.knob_name = knob_name
+        self.pad_name = pad_name
+        self.mode = mode
+        self.period = period  # seconds between steps in "steps" mode
+        self.period_ns = int(period * 1e9)
+        self.on_step = on_step  # called as on_step(sweep) after self.step is advanced
+        self.on_finish = on_finish  # called once when the sweep completes or is cancelled
+        self.step = 0
+        self.cancelled = False
+        self.finished = False
+        self.entry_id = None  # id of the sweep's live heap entry (older entries are stale)
+        self.start_ns = None  # set by begin() when the scheduler starts the sweep
+        self.steps_run = 0
+        self.steps_skipped = 0  # steps jumped over by the "skip" late policy
+        self.lateness_total_ns = 0
+        self.lateness_squares = 0
+        self.lateness_max_ns = 0
+        self.end_error_ns = None  # how late the final step ran (None until it has)
+        self._duration_ns = (steps - 1) * self.period_ns
+        self._origin_value = initial_value
+        self._origin_step = 0
+        if mode == "values":
+            self.steps = abs(target_value - initial_value)
+            self._increment = (target_value - initial_value) / self.steps if self.steps else 0  # +1 / -1
+            self._span_ns = self._duration_ns  # "values" deadlines run from _time_origin_ns to _time_origin_ns + _span_ns
+            self._time_origin_ns = None
+        else:
+            self.steps = steps
+            self._increment = (target_value - initial_value) / steps
+        self.target_value = target_value
+
+    def begin(self, start_ns):
+        self.start_ns = start_ns
+        self._time_origin_ns = start_ns
+
+    def value(self):
+        return int(self._origin_value + ((self.step - self._origin_step) * self._increment))
+
+    def retarget(self, target_value):
+        # Continue from the current position so the remaining steps land on the new target
+        if self.mode == "values":
+            # the remaining time is shared out between the values left to the new target
+            current = self.value()
+            end_ns = self._time_origin_ns + self._span_ns
+            self._time_origin_ns = self.deadline_ns(self.step) if self.step else self._time_origin_ns
+            self._span_ns = end_ns - self._time_origin_ns
+            remaining = max(abs(target_value - current), 1)
+            self._origin_value = current
+            self._origin_step = self.step
+            self._increment = (target_value - current) / remaining
+            self.steps = self.step + remaining
+            self.target_value = target_value
+            return
+        remaining = self.steps - self.step
+        self._origin_value = self._origin_value + ((self.step - self._origin_step) * self._increment)
+        self._origin_step = self.step
+        self._increment = (target_value - self._origin_value) / remaining if remaining else 0
+        self.target_value = target_value
+
+    def deadline_ns(self, step):
+        if self.mode == "values":
+            return self._time_origin_ns + (step - self._origin_step) * self._span_ns // (self.steps - self._origin_step)
+        return self.start_ns + (step - 1) * self.period_ns
+
+    def due_step(self, now_ns):
+        # Latest step whose deadline has passed
+        if self.mode == "values":
+            if self._span_ns <= 0:
+                return self.steps
+            return min(self._origin_step + (now_ns - self._time_origin_ns) * (self.steps - self._origin_step) // self._span_ns, self.steps)
+        if not self.period_ns:
+            return self.steps
+        return min((now_ns - self.start_ns) // self.period_ns + 1, self.steps)
+
+    def duration_ns(self):
+        # Requested time from the start to the last step
+        return self._duration_ns
+
+    def jitter_ns(self):
+        # Standard deviation of step lateness
+        if not self.steps_run:
+            return 0
+        mean = self.lateness_total_ns / self.steps_run
+        return math.sqrt(max(self.lateness_squares / self.steps_run - mean * mean, 0))
+
+    def _recordLateness(self, lateness_ns):
+        self.steps_run += 1
+        self.lateness_total_ns += lateness_ns
+        self.lateness_squares += lateness_ns * lateness_ns
+        if lateness_ns > self.lateness_max_ns:
+            self.lateness_max_ns = lateness_ns
+
+class SweepRegistry:
+    # Running sweeps keyed by knob name - every operation is a single locked dict access
+    def __init__(self):
+        self._sweeps = {}
+        self._lock = threading.Lock()
+
+    def put(self, sweep):
+        # Registers sweep for its knob and returns the sweep it replaced (or None)
+        with self._lock:
+            previous = self._sweeps.get(sweep.knob_name)
+            self._sweeps[sweep.knob_name] = sweep
+            return previous
+
+    def get(self, knob_name):
+        return self._sweeps.get(knob_name)
+
+    def pop(self, knob_name):
+        with self._lock:
+            return self._sweeps.pop(knob_name, None)
+
+    def discard(self, sweep):
+        # Removes sweep only if it is still the one registered for its knob (a no-op otherwise)
+        with self._lock:
+            if self._sweeps.get(sweep.knob_name) is sweep:
+                del self._sweeps[sweep.knob_name]
+
+    def running(self):
+        # Snapshot of the registered sweeps
+        with self._lock:
+            return list(self._sweeps.values())
+
+    def __contains__(self, knob_name):
+        return knob_name in self._sweeps
+
+    def __len__(self):
+        return len(self._sweeps)
+
+class SweepScheduler:
+    # Runs any number of concurrent sweeps from a single long-lived thread using a deadline heap
+    # start, cancel and retarget never create threads and cost at most one heap push
+    # late_policy decides what happens when a step runs after the next one was already due:
+    #   "skip" - jump straight to the latest step that is due, so values stay on schedule (the final step always runs)
+    #   "catch-up" - run every step, back to back until the sweep is on schedule again
+    LATE_POLICIES = ("skip", "catch-up")
+    # Condition.wait is only as fine as the system tick (about 15.6 ms on Windows), so it is only used to wait until
+    # WAIT_SLACK before a deadline (or for start / cancel); the rest is slept with time.sleep, which is high resolution
+    # (Python 3.11+ on Windows too), SLEEP_STEP at a time so a newly pushed earlier deadline is still picked up
+    WAIT_SLACK = 0.02
+    SLEEP_STEP = 0.001
+
+    def __init__(self, stats=None, late_policy="skip", clock=None):
+        # With a VirtualClock there is no thread - the clock calls run_due as it is advanced
+        if late_policy not in self.LATE_POLICIES:
+            raise ValueError(f"unknown late policy {late_policy!r} (expected one of {', '.join(self.LATE_POLICIES)})")
+        self.late_policy = late_policy
+        self.stats = stats if stats is not None else SweepStats()
+        self.stats.schedulers.append(self)
+        self._heap = []  # (deadline ns, entry_id, sweep)
+        self._active = 0
+        self._entry_ids = itertools.count()  # tie-breaker so the heap never compares sweeps
+        self._condition = threading.Condition()
+        self.clock = clock if clock is not None else SystemClock()
+        if self.clock.realtime:
+            self._thread = threading.Thread(target=self._run, name="SweepScheduler", daemon=True)
+            self._thread.start()
+        else:
+            self.clock.add_ticker(self)
+
+    def start(self, sweep):
+        with self._condition:
+            sweep.begin(self.clock.monotonic_ns())
+            if sweep.steps:
+                self._active += 1
+                self._push(sweep, sweep.deadline_ns(1))
+                self._condition.notify()
+                return
+            sweep.finished = True  # nothing to send - finish straight away on the caller's thread
+            sweep.end_error_ns = 0
+        self.stats.record_sweep(sweep)
+        sweep.on_finish(sweep)
+
+    def cancel(self, sweep):
+        # Returns True only for the caller that actually cancelled the sweep - on_finish still runs on the scheduler thread
+        with self._condition:
+            if sweep.cancelled or sweep.finished:
+                return False
+            sweep.cancelled = True
+            if sweep.entry_id is not None:  # waiting in the heap - bring its finish forward
+                self._push(sweep, self.clock.monotonic_ns())
+                self._condition.notify()
+            return True
+
+    def retarget(self, sweep, target_value):
+        with self._condition:
+            if sweep.cancelled or sweep.finished:
+                return False
+            sweep.retarget(target_value)
+            return True
+
+    def active_count(self):
+        return self._active
+
+    def _push(self, sweep, deadline_ns):
+        sweep.entry_id = next(self._entry_ids)
+        heapq.heappush(self._heap, (deadline_ns, sweep.entry_id, sweep))
 
-    def _open_midi_out_port(self, midiout, name):
-        ports = midiout.get_ports()
-        for i in range(len(ports)):
-            if name.lower() in ports[i].lower():
-                midiout.open_port(i)
-                return True
+    def next_deadline_ns(self):
+        # Deadline of the earliest live entry (None when idle)
+        with self._condition:
+            return self._peek()
+
+    def run_due(self, now):
+        # Runs every step due by now on the calling thread (how a VirtualClock drives the scheduler)
+        while True:
+            with self._condition:
+                deadline = self._peek()
+                if deadline is None or deadline > now:
+                    return
+                sweep = heapq.heappop(self._heap)[2]
+                sweep.entry_id = None
+            self._advance(sweep, now)
+
+    def _peek(self):
+        while self._heap:
+            deadline, entry_id, sweep = self._heap[0]
+            if entry_id == sweep.entry_id:
+                return deadline
+            heapq.heappop(self._heap)  # superseded by a later push
+        return None
+
+    def _next_due(self):
+        # Returns (sweep, now) once the earliest live entry is due
+        while True:
+            with self._condition:
+                deadline = self._peek()
+                if deadline is None:
+                    self._condition.wait()
+                    continue
+                now = self.clock.monotonic_ns()
+                if deadline <= now:
+                    sweep = heapq.heappop(self._heap)[2]
+                    sweep.entry_id = None
+                    return sweep, now
+                delay = (deadline - now) / 1e9
+                if delay > self.WAIT_SLACK:
+                    self._condition.wait(delay - self.WAIT_SLACK)  # start / cancel notify, so new work still wakes us
+                    continue
+            self.clock.sleep(min(delay, self.SLEEP_STEP))
+
+    def _run(self):
+        while True:
+            sweep, now = self._next_due()
+            self._advance(sweep, now)
+
+    def _advance(self, sweep, now):
+        if not sweep.cancelled:
+            step = sweep.step + 1
+            if self.late_policy == "skip":
+                due = sweep.due_step(now)
+                if due > step:
+                    sweep.steps_skipped += due - step
+                    step = due
+            lateness = now - sweep.deadline_ns(step)
+            sweep._recordLateness(lateness)
+            self.stats.lateness.record(lateness)
+            sweep.step = step
+            sweep.on_step(sweep)
+            if step == sweep.steps:
+                sweep.end_error_ns = lateness
+        with self._condition:
+            if not sweep.cancelled and sweep.step < sweep.steps:
+                self._push(sweep, sweep.deadline_ns(sweep.step + 1))
+                return
+            sweep.finished = True
+            self._active -= 1
+        self.stats.record_sweep(sweep)
+        sweep.on_finish(sweep)
+
+class FeedbackRenderer:
+    # Sends pad colour and knob position SysEx back to the Arturia from a shadow copy of the device state
+    # Only values that differ from what the device shows are sent, at most once per frame and latest value wins
+    PAD = 16  # SysEx parameter type for pad colours
+    KNOB = 0  # SysEx parameter type for knob positions
+
+    def __init__(self, midiports, frame_interval, stats=None, clock=None):
+        # With a VirtualClock there is no thread - the clock calls run_due as it is advanced
+        self.midiports = midiports
+        self.frame_interval = frame_interval
+        self.stats = stats  # DeviceStats that sent SysEx is counted against
+        self.clock = clock if clock is not None else SystemClock()
+        self._shown = {}  # (parameter type, id) -> value the device currently shows
+        self._pending = {}  # (parameter type, id) -> latest value waiting for the next frame
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._next_frame = 0  # clock.monotonic_ns() of the earliest next frame
+        if self.clock.realtime:
+            self._thread = threading.Thread(target=self._run, name="FeedbackRenderer", daemon=True)
+            self._thread.start()
+        else:
+            self.clock.add_ticker(self)
+
+    def set_knob_position(self, knob_id, value):
+        self._set((self.KNOB, knob_id), value)
+
+    def set_pad_colour(self, pad_id, colour):
+        self._set((self.PAD, pad_id), colour)
+
+    def observe_knob_position(self, knob_id, value):
+        # Records a change made on the device itself (e.g. the knob being turned) so it is not sent back
+        with self._lock:
+            self._shown[(self.KNOB, knob_id)] = value
+            self._pending.pop((self.KNOB, knob_id), None)
+
+    def resend_all(self):
+        # Forgets the shadow state so everything is sent again on the next frame (e.g. after the device is reconnected)
+        with self._lock:
+            for key, value in self._shown.items():
+                self._pending.setdefault(key, value)
+            self._shown.clear()
+        self._wakeup.set()
+        self.clock.wake()  # called from the PortWatcher thread
+
+    def flush(self):
+        # Sends every pending change now
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._shown.update(pending)
+        for (parameter_type, parameter_id), value in pending.items():
+            msg = [0xF0, 0, 32, 107, 127, 66, 2, 0, parameter_type, parameter_id, value, 247]
+            self.midiports.midiout_arturia.send_message(msg)
+        if self.stats is not None:
+            self.stats.sent[SYSTEM_MESSAGE] += len(pending)
+        return len(pending)
+
+    def _set(self, key, value):
+        with self._lock:
+            if self._shown.get(key) == value:
+                self._pending.pop(key, None)  # a queued change was undone before it was sent
+                return
+            self._pending[key] = value
+        self._wakeup.set()
+
+    def next_deadline_ns(self):
+        return self._next_frame if self._pending else None
+
+    def run_due(self, now):
+        if self._pending and now >= self._next_frame:
+            self.flush()
+            self._next_frame = now + int(self.frame_interval * 1e9)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            delay = self._next_frame - self.clock.monotonic_ns()
+            if delay > 0:
+                self.clock.sleep(delay / 1e9)
+            self._wakeup.clear()
+            self.flush()
+            self._next_frame = self.clock.monotonic_ns() + int(self.frame_interval * 1e9)
+
+class RingLogger:
+    # Diagnostics that are safe to log from the rtmidi callbacks: log() writes a fixed-size record into a preallocated
+    # ring buffer and never does I/O - a background thread formats and prints the records
+    def __init__(self, formats, size=1024, rate_limit=10, drain_interval=0.25):
+        self.formats = formats  # log code -> format string (positional fields)
+        self.size = size
+        self.rate_limit = rate_limit  # maximum records per log code per second
+        self.drain_interval = drain_interval
+        self.dropped = 0  # records lost because the buffer wrapped before they were drained
+        self.rate_limited = [0] * len(formats)  # records refused by the per-code rate limit
+        self._codes = [0] * size
+        self._arg1 = [None] * size
+        self._arg2 = [None] * size
+        self._sequence_numbers = [-1] * size  # sequence number of the record in each slot (written last)
+        self._sequence = itertools.count()  # next() is atomic so several callback threads can share the buffer
+        self._head = 0  # one past the newest committed sequence number
+        self._tail = 0  # next sequence number to drain
+        self._window_end = [0.0] * len(formats)
+        self._window_count = [0] * len(formats)
+        self._reported_drops = 0
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="RingLogger", daemon=True)
+            self._thread.start()
+
+    def log(self, code, arg1=None, arg2=None):
+        now = time.monotonic()
+        if now >= self._window_end[code]:
+            self._window_end[code] = now + 1.0
+            self._window_count[code] = 0
+        if self._window_count[code] >= self.rate_limit:
+            self.rate_limited[code] += 1
+            return
+        self._window_count[code] += 1
+        sequence_number = next(self._sequence)
+        slot = sequence_number % self.size
+        self._codes[slot] = code
+        self._arg1[slot] = arg1
+        self._arg2[slot] = arg2
+        self._sequence_numbers[slot] = sequence_number
+        if sequence_number >= self._head:
+            self._head = sequence_number + 1
+
+    def drain(self):
+        # Prints every committed record and returns the number printed
+        head = self._head
+        if head - self._tail > self.size:  # the writers lapped us
+            self.dropped += head - self.size - self._tail
+            self._tail = head - self.size
+        printed = 0
+        while self._tail < head:
+            slot = self._tail % self.size
+            sequence_number = self._sequence_numbers[slot]
+            if sequence_number < self._tail:
+                break  # still being written
+            code, arg1, arg2 = self._codes[slot], self._arg1[slot], self._arg2[slot]
+            if sequence_number != self._tail or self._sequence_numbers[slot] != self._tail:
+                self.dropped += 1  # overwritten before (or while) we read it
+            else:
+                print(self.formats[code].format(arg1, arg2))
+                printed += 1
+            self._tail += 1
+        total_drops = self.dropped + sum(self.rate_limited)
+        if total_drops != self._reported_drops:
+            print(f"LOG: {total_drops - self._reported_drops} diagnostic records dropped ({total_drops} in total)")
+            self._reported_drops = total_drops
+        return printed
+
+    def _run(self):
+        while True:
+            time.sleep(self.drain_interval)
+            self.drain()
+
+class InputCapture:
+    # Binary log of every input event: one 8 byte record per event, packed onto the end of an in-memory buffer (one
+    # struct pack on the callback thread) and written to disk by a background thread
+    # Record (CAPTURE_RECORD, read as a little-endian uint64): bits 0-3 port id (CAPTURE_PORT_IDS), 4-5 bytes used (1-3),
+    # 6 continuation of the previous record's message (longer messages such as SysEx), 8-31 up to three message bytes,
+    # 32-63 rtmidi delta time in microseconds
+    # The file is a 16 byte header (CAPTURE_MAGIC + start time in microseconds since the epoch) followed by the records,
+    # so it can be memory-mapped as an array of uint64 (see load_capture, or midi_batch.load_capture_array)
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.records = 0  # records written to disk so far
+        self._buffer = bytearray()
+        self._pack = CAPTURE_RECORD.pack
+        self._file = open(path, "wb")
+        self._file.write(CAPTURE_MAGIC + struct.pack("<Q", int(time.time() * 1e6)))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="InputCapture", daemon=True)
+        self._thread.start()
+
+    def record(self, port_id, event):
+        message, delta_time = event
+        delta_us = int(delta_time * 1000000 + 0.5)
+        if delta_us > 0xFFFFFFFF:
+            delta_us = 0xFFFFFFFF
+        length = len(message)
+        if length == 3:
+            self._buffer += self._pack(port_id | 0x30, message[0], message[1], message[2], delta_us)
+        elif length < 3:
+            self._buffer += self._pack(port_id | (length << 4), message[0], message[1] if length == 2 else 0, 0, delta_us)
+        else:
+            # All of a message's records go on in one append, so another port's callback thread can never land between them
+            records = []
+            for start in range(0, length, 3):
+                chunk = list(message[start:start + 3]) + [0, 0]
+                header = port_id | (min(length - start, 3) << 4) | (0x40 if start else 0)
+                records.append(self._pack(header, chunk[0], chunk[1], chunk[2], 0 if start else delta_us))
+            self._buffer += b"".join(records)
+
+    def flush(self):
+        # Moves everything recorded so far to disk - copying and deleting the front of the buffer are each atomic, and
+        # callbacks only ever add whole records at the end, so no lock is needed
+        buffer = self._buffer
+        count = len(buffer)
+        if not count:
+            return 0
+        chunk = bytes(buffer[:count])
+        del buffer[:count]
+        self._file.write(chunk)
+        self._file.flush()
+        self.records += count // 8
+        return count // 8
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+        self._file.close()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+class Histogram:
+    # Power-of-two nanosecond buckets, preallocated so record() only updates existing counters
+    def __init__(self, buckets=40):
+        self.counts = [0] * buckets  # counts[i] holds values below 2**i ns
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value_ns):
+        if value_ns < 0:
+            value_ns = 0
+        index = value_ns.bit_length()
+        if index >= len(self.counts):
+            index = len(self.counts) - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value_ns
+        if value_ns > self.max:
+            self.max = value_ns
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the given fraction of values
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return 2 ** index
+        return None
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean_ns": self.total / self.count if self.count else None,
+            "max_ns": self.max,
+            "p50_ns": self.percentile(0.5),
+            "p99_ns": self.percentile(0.99),
+            "p99.9_ns": self.percentile(0.999),
+            "buckets": {str(2 ** index): count for index, count in enumerate(self.counts) if count},
+        }
+
+class DeviceStats:
+    # Per message type (upper 4 bits of the status byte) counters and processing times for one device's callback
+    # Processing times are only recorded while the callback is timed (initialise_callback(timed=True))
+    # The counters are plain list slots so the hot path never allocates - concurrent increments may very occasionally be lost
+    BUCKETS = 40
+
+    def __init__(self, name):
+        self.name = name
+        self.received = [0] * 16
+        self.sent = [0] * 16  # indexed by the type of the message sent
+        self.ignored = [0] * 16
+        self.processing_counts = [0] * (16 * self.BUCKETS)  # flat [msg_type * BUCKETS + power-of-two bucket]
+        self.processing_total = [0] * 16
+
+    def record(self, msg_type, elapsed_ns):
+        # Inlined histogram update - this runs once per message
+        self.received[msg_type] += 1
+        self.processing_total[msg_type] += elapsed_ns
+        bucket = elapsed_ns.bit_length()
+        self.processing_counts[(msg_type * self.BUCKETS) + (bucket if bucket < self.BUCKETS else self.BUCKETS - 1)] += 1
+
+    def processing(self, msg_type):
+        # Histogram view of one message type's processing times
+        histogram = Histogram(self.BUCKETS)
+        histogram.counts = self.processing_counts[msg_type * self.BUCKETS:(msg_type + 1) * self.BUCKETS]
+        histogram.count = sum(histogram.counts)
+        histogram.total = self.processing_total[msg_type]
+        histogram.max = None  # not tracked on the hot path
+        return histogram
+
+    def snapshot(self):
+        snapshot = {}
+        for msg_type in range(16):
+            if self.received[msg_type] or self.sent[msg_type] or self.ignored[msg_type]:
+                snapshot[MIDI_MESSAGE_TYPES.get(msg_type, "Data Byte")] = {
+                    "in": self.received[msg_type],
+                    "out": self.sent[msg_type],
+                    "ignored": self.ignored[msg_type],
+                    "processing": self.processing(msg_type).snapshot(),
+                }
+        return snapshot
+
+class LatencyStats:
+    # Where one input port's messages spend their time (opt-in, see MidiPorts.start_latency_tracking):
+    # queue is driver timestamp -> the router's callback entered (rtmidi's queue plus waiting for the GIL - before the
+    # handoff in the asyncio core), python is the device callback itself and output is driver timestamp -> written to an
+    # output port, for every message routed from this port
+    # rtmidi only reports the delta time since the port's previous message, so driver timestamps are rebuilt by summing
+    # the deltas and anchoring the sum at the message that reached Python soonest (the least delayed one seen so far)
+    def __init__(self):
+        self.queue = Histogram()
+        self.python = Histogram()
+        self.output = Histogram()
+        self.restart()
+
+    def restart(self):
+        self.elapsed_ns = 0  # sum of the delta times so far
+        self.offset_ns = None  # clock time of delta time 0
+
+    def arrival(self, delta_time, now):
+        # Returns the message's driver timestamp on the router clock and records its queue time
+        self.elapsed_ns += int(delta_time * 1000000000 + 0.5)
+        offset = now - self.elapsed_ns
+        if self.offset_ns is None or offset < self.offset_ns:
+            self.offset_ns = offset
+        self.queue.record(offset - self.offset_ns)
+        return self.offset_ns + self.elapsed_ns
+
+    def snapshot(self):
+        return {
+            "queue": self.queue.snapshot(),
+            "python": self.python.snapshot(),
+            "output": self.output.snapshot(),
+        }
+
+class OutputStats:
+    # One OutputScheduler's counters, indexed by priority class (notes, channel, sysex)
+    def __init__(self):
+        self.sent = [0, 0, 0]
+        self.coalesced = [0, 0, 0]
+        self.dropped = [0, 0, 0]
+        self.wait = [Histogram(), Histogram(), Histogram()]  # enqueue to send
+        self.max_depth = 0
+        self.overflows = 0  # messages refused because the inbox or note queue was full
+        self.errors = 0  # sends the port raised on
+        self.schedulers = []
+
+    def snapshot(self):
+        snapshot = {
+            "depth": sum(scheduler.pending() for scheduler in self.schedulers),
+            "max_depth": self.max_depth,
+            "overflows": self.overflows,
+            "errors": self.errors,
+        }
+        for priority, name in enumerate(OutputScheduler.CLASS_NAMES):
+            snapshot[name] = {
+                "sent": self.sent[priority],
+                "coalesced": self.coalesced[priority],
+                "dropped": self.dropped[priority],
+                "wait": self.wait[priority].snapshot(),
+            }
+        return snapshot
+
+class SweepStats:
+    # Shared by sweep schedulers - lateness is how long after its deadline each step was started
+    # jitter and end_error are per completed sweep (see Sweep.jitter_ns / Sweep.end_error_ns)
+    def __init__(self):
+        self.schedulers = []
+        self.lateness = Histogram()
+        self.jitter = Histogram()
+        self.end_error = Histogram()
+        self.completed = 0
+        self.cancelled = 0
+        self.steps_skipped = 0
+
+    def record_sweep(self, sweep):
+        self.steps_skipped += sweep.steps_skipped
+        if sweep.steps_run:
+            self.jitter.record(int(sweep.jitter_ns()))
+        if sweep.end_error_ns is None:
+            self.cancelled += 1
+            return
+        self.completed += 1
+        self.end_error.record(sweep.end_error_ns)
+
+    def snapshot(self):
+        return {
+            "active": sum(scheduler.active_count() for scheduler in self.schedulers),
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "steps_skipped": self.steps_skipped,
+            "step_lateness": self.lateness.snapshot(),
+            "sweep_jitter": self.jitter.snapshot(),
+            "sweep_end_error": self.end_error.snapshot(),
+        }
+
+class RouterStats:
+    # Live counters for the whole router - snapshot() can be taken at any time without pausing routing
+    def __init__(self):
+        self.devices = {}
+        self.sweeps = SweepStats()
+        self.outputs = {}  # port attribute -> OutputStats
+        self.latency = {}  # input port attribute -> LatencyStats (only while latency tracking is on)
+
+    def input_latency(self, name):
+        if name not in self.latency:
+            self.latency[name] = LatencyStats()
+        return self.latency[name]
+
+    def output(self, name):
+        if name not in self.outputs:
+            self.outputs[name] = OutputStats()
+        return self.outputs[name]
+
+    def device(self, name):
+        if name not in self.devices:
+            self.devices[name] = DeviceStats(name)
+        return self.devices[name]
+
+    def snapshot(self):
+        return {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "devices": {name: device.snapshot() for name, device in list(self.devices.items())},
+            "sweeps": self.sweeps.snapshot(),
+            "outputs": {name: output.snapshot() for name, output in list(self.outputs.items())},
+            "latency": {name: latency.snapshot() for name, latency in list(self.latency.items())},
+        }
+
+    def dump(self, path=None):
+        # Writes a JSON snapshot to path (replaced atomically) or to stdout
+        text = json.dumps(self.snapshot(), indent=2)
+        if path is None:
+            print(text)
+            return
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(text)
+        os.replace(temp_path, path)
+
+    def install_signal_handler(self, path=None):
+        # Dump a snapshot whenever the process receives SIGUSR1 (not available on Windows)
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump(path))
+            return True
         return False
-    
+
+    def start_file_writer(self, path, interval):
+        # Rewrites path with a fresh snapshot every interval seconds
+        def write_periodically():
+            while True:
+                time.sleep(interval)
+                self.dump(path)
+        thread = threading.Thread(target=write_periodically, name="StatsFileWriter", daemon=True)
+        thread.start()
+        return thread
+
+class VelocityCurve:
+    # Velocity response for a key zone, precomputed as 128 x 128 tables: table[pedal][velocity] -> velocity to send
+    # The curve shapes the played velocity and the expression pedal then cuts it (0 = no cut, 127 = silent) as bass mode
+    # always has - "linear" gives exactly the original int(velocity * (127 - pedal) / 127)
+    # amount is the exponent for "exponential" (default 2) and the steepness for "s-curve" (default 8), points are the
+    # (velocity in, velocity out) pairs that "custom" interpolates between
+    KINDS = ("linear", "exponential", "s-curve", "custom")
+
+    def __init__(self, kind="linear", amount=None, points=None):
+        if kind not in self.KINDS:
+            raise ValueError(f"unknown velocity curve {kind!r} (expected one of {', '.join(self.KINDS)})")
+        if amount is None:
+            amount = {"exponential": 2.0, "s-curve": 8.0}.get(kind)
+        elif kind not in ("exponential", "s-curve") or amount <= 0:
+            raise ValueError("amount must be a positive number and only applies to exponential and s-curve curves")
+        if kind == "custom":
+            points = sorted((int(velocity_in), int(velocity_out)) for velocity_in, velocity_out in points or ())
+            if len(points) < 2 or any(not 0 <= value <= 127 for point in points for value in point):
+                raise ValueError("custom curves need at least two points with values from 0 to 127")
+            if len({velocity_in for velocity_in, velocity_out in points}) < len(points):
+                raise ValueError("custom curve points must have different input velocities")
+        elif points is not None:
+            raise ValueError("points only apply to custom curves")
+        self.kind = kind
+        self.amount = amount
+        self.points = points
+        self.table = self._buildTable()
+
+    def shape(self, velocity):
+        if self.kind == "linear":
+            return velocity
+        if self.kind == "exponential":
+            return 127 * (velocity / 127) ** self.amount
+        if self.kind == "s-curve":
+            # logistic through the middle of the range, rescaled so 0 -> 0 and 127 -> 127
+            low, high = self._logistic(0), self._logistic(127)
+            return 127 * (self._logistic(velocity) - low) / (high - low)
+        points = self.points
+        if velocity <= points[0][0]:
+            return points[0][1]
+        for (x0, y0), (x1, y1) in zip(points, points[1:]):
+            if velocity <= x1:
+                return y0 + (y1 - y0) * (velocity - x0) / (x1 - x0)
+        return points[-1][1]
+
+    def _logistic(self, velocity):
+        return 1 / (1 + math.exp(-self.amount * (velocity / 127 - 0.5)))
+
+    def _buildTable(self):
+        shaped = [self.shape(velocity) for velocity in range(128)]
+        table = []
+        for pedal in range(128):
+            row = bytearray(int(value * (127 - pedal) / 127) for value in shaped)
+            row[0] = 0  # a Note On with velocity 0 is a Note Off and has to stay one
+            table.append(bytes(row))
+        return table
+
+class Rule:
+    # Declarative routing rule: match on message type / channel / data byte values -> transform -> outputs
+    # types, channels, data1 and data2 are containers tested with "in" (None matches anything, tuples, sets and ranges all work)
+    # System messages are only matched by rules that list SYSTEM_MESSAGE in types
+    # transform(message, msg_channel) returns the message to send (None to send nothing) - without a transform the message
+    # is sent unchanged, and a rule with neither transform nor outputs ignores the message
+    def __init__(self, types=None, channels=None, data1=None, data2=None, transform=None, outputs=()):
+        self.types = types
+        self.channels = channels
+        self.data1 = data1
+        self.data2 = data2
+        self.transform = transform
+        self.outputs = tuple(outputs)  # MidiPorts attribute names, e.g. "midiout_loopbe"
+
+    def matches_status(self, msg_type, msg_channel):
+        if msg_type == SYSTEM_MESSAGE:
+            return self.types is not None and SYSTEM_MESSAGE in self.types
+        if self.types is not None and msg_type not in self.types:
+            return False
+        return self.channels is None or msg_channel in self.channels
+
+    def compile(self, device):
+        # Returns a handler(message, msg_channel) specialised for this rule's transform and outputs
+        # Output ports are looked up by name when sending so ports replaced on MidiPorts are picked up
+        transform = self.transform
+        outputs = self.outputs
+        midiports = device.midiports
+        sent = device.stats.sent  # counted inline rather than through device._send to save a call per message
+        if not outputs:
+            if transform is not None:
+                return transform
+            ignored = device.stats.ignored
+            def ignore(message, msg_channel):
+                ignored[message[0] >> 4] += 1
+            return ignore
+        if len(outputs) == 1:
+            output = outputs[0]
+            if transform is None:
+                def forward(message, msg_channel):
+                    sent[message[0] >> 4] += 1
+                    getattr(midiports, output).send_message(message)
+                return forward
+            def transform_and_forward(message, msg_channel):
+                msg = transform(message, msg_channel)
+                if msg is not None:
+                    sent[msg[0] >> 4] += 1
+                    getattr(midiports, output).send_message(msg)
+            return transform_and_forward
+        def transform_and_fan_out(message, msg_channel):
+            msg = transform(message, msg_channel) if transform is not None else message
+            if msg is not None:
+                for output in outputs:
+                    sent[msg[0] >> 4] += 1
+                    getattr(midiports, output).send_message(msg)
+        return transform_and_fan_out
+
+class DeviceProfileError(ValueError):
+    pass
+
+class DeviceProfile:
+    # Validated device map (ports, Roland and Arturia settings) loaded from a TOML or JSON file - see profiles/default.toml
+    # Everything is checked once at startup so the devices can build their lookup tables without further checks
+    def __init__(self, data, source="profile"):
+        self.source = source
+        ports = self._section(data, "ports")
+        self.port_names = {device: self._portSpec(ports, device) for device in ("arturia", "roland", "loopbe")}
+        self.outputs = None  # device -> bytes per second for its OutputScheduler (None when there is no [outputs] section)
+        if "outputs" in data:
+            outputs = self._section(data, "outputs")
+            self.outputs = {device: self._integer(outputs, device, "outputs", 0, 10000000) if device in outputs else 0 for device in ("arturia", "roland", "loopbe")}
+        roland = self._section(data, "roland")
+        self.roland = {
+            "name": self._string(roland, "name", "roland"),
+            "midi_channel": self._channel(roland, "midi_channel", "roland"),
+            "midi_channel_bass": self._channel(roland, "midi_channel_bass", "roland"),
+            "bass_upper_key": self._note(roland, "bass_upper_key", "roland"),
+        }
+        self.roland["velocity_zones"] = self._velocityZones(roland, self.roland["bass_upper_key"])
+        self.arturia = self._loadArturia(self._section(data, "arturia"))
+
+    def _loadArturia(self, arturia):
+        config = {
+            "name": self._string(arturia, "name", "arturia"),
+            "midi_channel": self._channel(arturia, "midi_channel", "arturia"),
+            "midi_channel_organ": self._channel(arturia, "midi_channel_organ", "arturia"),
+            "transition_steps": self._integer(arturia, "transition_steps", "arturia", 2, 100000),
+            "feedback_fps": self._integer(arturia, "feedback_fps", "arturia", 1, 1000),
+            "base_pitch": self._note(arturia, "base_pitch", "arturia"),
+            "sweep_late_policy": arturia.get("sweep_late_policy", "skip"),
+            "sweep_mode": arturia.get("sweep_mode", "steps"),
+            "knob_cc": {}, "knob_sysex_id": {}, "knob_values": {},
+            "pad_note_values": {}, "pad_colours": {}, "pad_linked_to_knob": {},
+        }
+        if config["sweep_late_policy"] not in SweepScheduler.LATE_POLICIES:
+            self._fail(f"arturia.sweep_late_policy must be one of {', '.join(SweepScheduler.LATE_POLICIES)}")
+        if config["sweep_mode"] not in Sweep.MODES:
+            self._fail(f"arturia.sweep_mode must be one of {', '.join(Sweep.MODES)}")
+        if config["transition_steps"] % 2:
+            self._fail("arturia.transition_steps must be a multiple of 2")
+        knobs = arturia.get("knobs")
+        if not isinstance(knobs, list) or not knobs:
+            self._fail("arturia.knobs must be a non-empty list")
+        for i, knob in enumerate(knobs):
+            where = f"arturia.knobs[{i}]"
+            name = self._string(knob, "name", where)
+            if name in config["knob_cc"]:
+                self._fail(f"{where}: duplicate knob name {name!r}")
+            config["knob_cc"][name] = self._dataByte(knob, "cc", where)
+            config["knob_sysex_id"][name] = self._dataByte(knob, "sysex_id", where)
+            config["knob_values"][name] = self._dataByte(knob, "value", where)
+        self._checkUnique(config["knob_cc"], "arturia.knobs", "cc")
+        pads = arturia.get("pads")
+        if not isinstance(pads, list) or not pads:
+            self._fail("arturia.pads must be a non-empty list")
+        for i, pad in enumerate(pads):
+            where = f"arturia.pads[{i}]"
+            name = self._string(pad, "name", where)
+            if name in config["pad_note_values"]:
+                self._fail(f"{where}: duplicate pad name {name!r}")
+            config["pad_note_values"][name] = self._integer(pad, "note", where, 0, 15)  # pad SysEx IDs are 112 + note
+            config["pad_colours"][name] = self._dataByte(pad, "colour", where)
+            knob_name = self._string(pad, "knob", where)
+            if knob_name not in config["knob_cc"]:
+                self._fail(f"{where}: knob {knob_name!r} is not defined in arturia.knobs")
+            config["pad_linked_to_knob"][name] = knob_name
+        self._checkUnique(config["pad_note_values"], "arturia.pads", "note")
+        target_knob = self._string(arturia, "target_knob", "arturia")
+        if target_knob not in config["knob_cc"]:
+            self._fail(f"arturia.target_knob: knob {target_knob!r} is not defined in arturia.knobs")
+        config["target_knob"] = target_knob
+        rotary_switch_pads = arturia.get("rotary_switch_pads", [])
+        for pad_name in rotary_switch_pads:
+            if pad_name not in config["pad_note_values"]:
+                self._fail(f"arturia.rotary_switch_pads: pad {pad_name!r} is not defined in arturia.pads")
+        config["rotary_switch_pads"] = tuple(rotary_switch_pads)
+        return config
+
+    def _velocityZones(self, roland, bass_upper_key):
+        # List of (lowest note, highest note, VelocityCurve) - without velocity_zones everything up to bass_upper_key is linear
+        zones = roland.get("velocity_zones")
+        if zones is None:
+            return [(0, bass_upper_key, VelocityCurve())]
+        if not isinstance(zones, list) or not zones:
+            self._fail("roland.velocity_zones must be a non-empty list")
+        result = []
+        taken = {}
+        for i, zone in enumerate(zones):
+            where = f"roland.velocity_zones[{i}]"
+            low = self._note(zone, "low", where) if "low" in zone else 0
+            high = self._note(zone, "high", where)
+            if low > high:
+                self._fail(f"{where}: low is above high")
+            amount = zone.get("amount")
+            if amount is not None and (not isinstance(amount, (int, float)) or isinstance(amount, bool)):
+                self._fail(f"{where}.amount must be a number")
+            try:
+                curve = VelocityCurve(zone.get("curve", "linear"), amount, zone.get("points"))
+            except (TypeError, ValueError) as e:
+                self._fail(f"{where}: {e}")
+            for note in range(low, high + 1):
+                if note in taken:
+                    self._fail(f"{where} overlaps roland.velocity_zones[{taken[note]}] at note {note}")
+                taken[note] = i
+            result.append((low, high, curve))
+        return result
+
+    def _fail(self, message):
+        raise DeviceProfileError(f"{self.source}: {message}")
+
+    def _section(self, data, key):
+        if not isinstance(data.get(key), dict):
+            self._fail(f"missing [{key}] section")
+        return data[key]
+
+    def _string(self, table, key, where):
+        value = table.get(key)
+        if not isinstance(value, str) or not value:
+            self._fail(f"{where}.{key} must be a non-empty string")
+        return value
+
+    def _integer(self, table, key, where, low, high):
+        value = table.get(key)
+        if not isinstance(value, int) or isinstance(value, bool) or not low <= value <= high:
+            self._fail(f"{where}.{key} must be an integer from {low} to {high}, got {value!r}")
+        return value
+
+    def _dataByte(self, table, key, where):
+        return self._integer(table, key, where, 0, 127)
+
+    def _channel(self, table, key, where):
+        return self._integer(table, key, where, 1, 16)
+
+    def _note(self, table, key, where):
+        # Accepts a note name from MIDI_NOTE_VALUES (e.g. "F3") or a note number
+        value = table.get(key)
+        if isinstance(value, str):
+            if value not in MIDI_NOTE_VALUES:
+                self._fail(f"{where}.{key}: unknown note name {value!r}")
+            return MIDI_NOTE_VALUES[value]
+        return self._dataByte(table, key, where)
+
+    def _portSpec(self, ports, device):
+        # Either a substring of the port name or a table such as { name = "Arturia MiniLab mkII 0", match = "exact" }
+        if isinstance(ports.get(device), dict):
+            pattern = self._string(ports[device], "name", "ports." + device)
+            match = ports[device].get("match", "substring")
+        else:
+            pattern = self._string(ports, device, "ports")
+            match = "substring"
+        try:
+            return PortSpec(pattern, match)
+        except (ValueError, re.error) as e:
+            self._fail(f"ports.{device}: {e}")
+
+    def _checkUnique(self, mapping, where, key):
+        seen = {}
+        for name, value in mapping.items():
+            if value in seen:
+                self._fail(f"{where}: {name!r} and {seen[value]!r} share {key} {value}")
+            seen[value] = name
+
 class Roland:
-    def __init__(self, midiports):
+    def __init__(self, midiports, profile=None):
         self.midiports = midiports
+        if profile is None:
+            profile = load_device_profile(DEFAULT_PROFILE)
+        config = profile.roland
         # Define constants
-        self.NAME = "Roland"
-        self.MIDI_CHANNEL = 1
-        self.MIDI_CHANNEL_BASS = 2
-        self.BASS_UPPER_KEY = MIDI_NOTE_VALUES["F3"]   # F below middle C
+        self.NAME = config["name"]
+        self.MIDI_CHANNEL = config["midi_channel"]
+        self.MIDI_CHANNEL_BASS = config["midi_channel_bass"]
+        self.BASS_UPPER_KEY = config["bass_upper_key"]
         # Define variables
         self.exp_pedal_value = 0
         self.bass_mode = False
+        self.stats = router_stats.device(self.NAME)
+        self.set_velocity_zones(config["velocity_zones"])
+
+    def set_velocity_zones(self, zones):
+        # zones is a list of (lowest note, highest note, VelocityCurve) for notes on MIDI_CHANNEL that bass mode rescales
+        # Curve tables are built when a VelocityCurve is created, so changing zones only rebuilds these lookups
+        self.velocity_zones = list(zones)
+        self._curve_by_note = [None] * 128  # note -> VelocityCurve.table
+        for low, high, curve in self.velocity_zones:
+            for note in range(low, high + 1):
+                self._curve_by_note[note] = curve.table
+        self._dispatch = self._buildDispatchTable()
 
     def initialise_bassmode(self):
         prompt = "\nWould you like to turn bass mode on? (Please enter 'y' for yes or 'n' for no)\n"
         user_input = input(prompt).strip().lower()
         if user_input == "y": self.bass_mode = True
 
-    def initialise_callback(self):
-        self.midiports.midiin_roland.set_callback(self._callback)
+    def initialise_callback(self, timed=False):
+        # timed=True also records every message's processing time in the stats (two clock reads per message)
+        self.midiports.set_callback("roland", self._timedCallback if timed else self._callback)
 
     def _callback(self, msg, data):
-        status_byte, data_byte_1, data_byte_2 = msg[0]
-        msg_type = MIDI_MESSAGE_TYPES[status_byte//16]  # alternatively use bitwise operation to extract first 4 bits: msg_type = (status_byte & 0xF0) >> 4
-        msg_channel = (status_byte%16) + 1   # alternatively use bitwise operation to extract last 4 bits: msg_channel = status_byte & 0x0F
-        # Catch messages to ignore
-        if msg_type == "System Message":
-            print(f"UNEXPECTED SYSTEM MESSAGE: from {self.NAME}")
-            return
-        if msg_channel != self.MIDI_CHANNEL and msg_channel != self.MIDI_CHANNEL_BASS: 
-            print(f"UNEXPECTED CHANNEL MESSAGE: from {self.NAME} on channel {msg_channel}")
-            return
-        # Update exp_pedal_value
-        if msg_type == "Control Change" and data_byte_1 == 7:      # control change from expression pedal
-            self.exp_pedal_value = data_byte_2
+        message = msg[0]
+        msg_type, msg_channel, handler = self._dispatch[message[0]]
+        self.stats.received[msg_type] += 1
+        handler(message, msg_channel)
+
+    def _timedCallback(self, msg, data):
+        started = time.perf_counter_ns()
+        message = msg[0]
+        msg_type, msg_channel, handler = self._dispatch[message[0]]
+        handler(message, msg_channel)
+        self.stats.record(msg_type, time.perf_counter_ns() - started)
+
+    def _send(self, midiout, msg):
+        self.stats.sent[msg[0] >> 4] += 1
+        midiout.send_message(msg)
+
+    def _buildDispatchTable(self):
+        return compile_rules(self._buildRules(), self, self._onSystemMessage)
+
+    def _buildRules(self):
+        channels = (self.MIDI_CHANNEL, self.MIDI_CHANNEL_BASS)
+        return [
+            Rule(types=(SYSTEM_MESSAGE,), transform=self._onSystemMessage),
+            Rule(types=(CONTROL_CHANGE,), channels=channels, data1=(7,), transform=self._updateExpPedal, outputs=("midiout_loopbe",)),   # control change from expression pedal
+            Rule(types=(NOTE_ON,), channels=(self.MIDI_CHANNEL,), data1={note for note in range(128) if self._curve_by_note[note]}, transform=self._scaleBassVelocity, outputs=("midiout_loopbe",)),
+            Rule(channels=channels, outputs=("midiout_loopbe",)),  # forward everything else on the organ and bass channels
+            Rule(transform=self._onUnexpectedChannel),
+        ]
+
+    def _onSystemMessage(self, message, msg_channel):
+        self.stats.ignored[SYSTEM_MESSAGE] += 1
+        diagnostics.log(LOG_UNEXPECTED_SYSTEM, self.NAME)
+
+    def _onUnexpectedChannel(self, message, msg_channel):
+        self.stats.ignored[message[0] >> 4] += 1
+        diagnostics.log(LOG_UNEXPECTED_CHANNEL, self.NAME, msg_channel)
+
+    def _updateExpPedal(self, message, msg_channel):
+        self.exp_pedal_value = message[2]
+        return message
+
+    def _scaleBassVelocity(self, message, msg_channel):
         # Tweak velocities if bass mode on
-        if self.bass_mode and msg_type == "Note On" and data_byte_1 <= self.BASS_UPPER_KEY and msg_channel == self.MIDI_CHANNEL:
-            data_byte_2 = int(data_byte_2 * (127 - self.exp_pedal_value) / 127)
-        # Forward midi message
-        msg = [status_byte, data_byte_1, data_byte_2]
-        self.midiports.midiout_loopbe.send_message(msg)
+        if not self.bass_mode:
+            return message
+        status_byte, data_byte_1, data_byte_2 = message
+        data_byte_2 = self._curve_by_note[data_byte_1][self.exp_pedal_value][data_byte_2]
+        return [status_byte, data_byte_1, data_byte_2]
 
 class Arturia:
-    def __init__(self, midiports):
+    def __init__(self, midiports, profile=None):
         self.midiports = midiports
-        # Define constants
-        self.NAME = "Arturia"
-        self.MIDI_CHANNEL = 3
-        self.MIDI_CHANNEL_ORGAN = 1
-        self.KNOB_CC = {"knob1": 102, "knob2": 103, "knob3": 104, "knob4": 105, "knob5": 106, "knob6": 107, "knob7": 108, "knob8": 109, 
-                        "knob9": 110, "knob10": 111, "knob11": 112, "knob12": 113, "knob13": 114, "knob14": 115, "knob15": 116, "knob16": 117}  # Must match values set in Arturia's Midi Control Center
-        self.KNOB_SYSEX_ID = {"knob1": 48, "knob2": 1, "knob3": 2, "knob4": 9, "knob5": 11, "knob6": 12, "knob7": 13, "knob8": 14, 
-                        "knob9": 51, "knob10": 3, "knob11": 4, "knob12": 10, "knob13": 5, "knob14": 6, "knob15": 7, "knob16": 8}    # Knob ID values used in sysex (converted from hexadecimal to decimal)
-        self.PAD_NOTE_VALUES = {"pad1": 0, "pad2": 1, "pad3": 2, "pad4": 3, "pad5": 4, "pad6": 5, "pad7": 6, "pad8": 7, 
-                                "pad9": 8, "pad10": 9, "pad11": 10, "pad12": 11, "pad13": 12, "pad14": 13, "pad15": 14, "pad16": 15}   # Must match values set in Arturia's Midi Control Center - they correspond to C-1 C#-1 etc. - will break _updatePadColour procedure if changed
-        self.PAD_ROTARY_SWITCH = ("pad6", "pad14")  # Pads used to turn rotary on and off
-        self.PAD_LINKED_TO_KNOB = {"pad1": "knob1", "pad2": "knob2", "pad3": "knob3", "pad4": "knob4", "pad5": "knob5", "pad6": "knob6", "pad7": "knob7", "pad8": "knob8", 
-                                   "pad9": "knob9", "pad10": "knob10", "pad11": "knob11", "pad12": "knob12", "pad13": "knob13", "pad14": "knob14", "pad15": "knob15", "pad16": "knob8"}  # From 1 to 16 - CHANGE THIS if you wish to link a pad to a different knob
-        self.PAD_COLOURS = {"pad1": 20, "pad2": 20, "pad3": 127, "pad4": 5, "pad5": 1, "pad6": 0, "pad7": 17, "pad8": 20, 
-                            "pad9": 20, "pad10": 20, "pad11": 127, "pad12": 5, "pad13": 1, "pad14": 0, "pad15": 17, "pad16": 20}  # 0 black, 1 red, 4 green, 5 yellow, 16 blue, 17 magenta, 20 cyan, 127 white
-        self.TRANSITION_STEPS = 60  # Must be multiple of 2
+        if profile is None:
+            profile = load_device_profile(DEFAULT_PROFILE)
+        config = profile.arturia
+        # Define constants (see profiles/default.toml)
+        self.NAME = config["name"]
+        self.MIDI_CHANNEL = config["midi_channel"]
+        self.MIDI_CHANNEL_ORGAN = config["midi_channel_organ"]
+        self.KNOB_CC = dict(config["knob_cc"])
+        self.KNOB_SYSEX_ID = dict(config["knob_sysex_id"])
+        self.PAD_NOTE_VALUES = dict(config["pad_note_values"])  # will break _updatePadColour procedure if pad notes do not start at 0
+        self.PAD_ROTARY_SWITCH = tuple(config["rotary_switch_pads"])
+        self.PAD_LINKED_TO_KNOB = dict(config["pad_linked_to_knob"])
+        self.PAD_COLOURS = dict(config["pad_colours"])
+        self.TRANSITION_STEPS = config["transition_steps"]
+        self.FEEDBACK_FPS = config["feedback_fps"]
+        self.SWEEP_MODE = config["sweep_mode"]
         # Define variables
         self.rotary_on = False
-        self.knob_values = {"knob1": 127, "knob2": 127, "knob3": 127, "knob4": 90, "knob5": 100, "knob6": 127, "knob7": 127, "knob8": 127, 
-                        "knob9": 90, "knob10": 0, "knob11": 0, "knob12": 0, "knob13": 0, "knob14": 0, "knob15": 60, "knob16": 0}   # These default values are edited by this application
-        self.target_knob_name = "knob16"  # Between 1 and 16 - changed when pressure pads are used to trigger a transition
-        self.base_pitch = MIDI_NOTE_VALUES["C1"]   # Default pitch for pad sound is C
+        self.knob_values = dict(config["knob_values"])   # These default values are edited by this application
+        self.target_knob_name = config["target_knob"]  # changed when pressure pads are used to trigger a transition
+        self.base_pitch = config["base_pitch"]
         self.octave_transpose = 0
         self.notes_on = []
+        self.stats = router_stats.device(self.NAME)
+        self.scheduler = SweepScheduler(router_stats.sweeps, config["sweep_late_policy"], midiports.clock)  # one thread runs every pad-triggered sweep
+        self.sweeps = SweepRegistry()  # knob name -> running sweep
+        self.renderer = FeedbackRenderer(midiports, 1 / self.FEEDBACK_FPS, self.stats, midiports.clock)
+        midiports.add_reconnect_listener(self._onReconnect)
+        self._dispatch = self._buildDispatchTable()
+        self._buildLookupTables()
+
+    def update_mappings(self, knob_cc=None, pad_note_values=None):
+        # Use this (rather than editing KNOB_CC / PAD_NOTE_VALUES directly) so the reverse lookups stay in step
+        if knob_cc is not None:
+            self.KNOB_CC = dict(knob_cc)
+        if pad_note_values is not None:
+            self.PAD_NOTE_VALUES = dict(pad_note_values)
+        self._buildLookupTables()
+        self._dispatch = self._buildDispatchTable()  # the routing rules match on the mapped CC and note values
+
+    def _buildLookupTables(self):
+        # Knob tables indexed by knob number (profile order) plus 128-entry reverse indexes (data byte -> knob number /
+        # pad name), so the callback never scans the mapping dicts
+        self._knob_names = tuple(self.KNOB_CC)
+        self._knob_index = {knob_name: index for index, knob_name in enumerate(self._knob_names)}
+        self._knob_cc = [self.KNOB_CC[knob_name] for knob_name in self._knob_names]
+        self._knob_sysex = [self.KNOB_SYSEX_ID[knob_name] for knob_name in self._knob_names]  # SysEx parameter id
+        self._knob_by_cc = build_reverse_index(dict(enumerate(self._knob_cc)))
+        self._target_knob = self._knob_index[self.target_knob_name]
+        self._pad_by_note = build_reverse_index(self.PAD_NOTE_VALUES)
 
-    def initialise_callback(self):
-        self.midiports.midiin_arturia.set_callback(self._callback)
+    def initialise_callback(self, timed=False):
+        # timed=True also records every message's processing time in the stats (two clock reads per message)
+        self.midiports.set_callback("arturia", self._timedCallback if timed else self._callback)
+
+    def _onReconnect(self, device, direction):
+        # A replugged MiniLab has forgotten its knob positions and pad colours - send them all in the next frame
+        if device == "arturia" and direction == "out":
+            self.renderer.resend_all()
 
     def initialise_knobs_and_pads(self):
         status_byte = 0xB0 + self.MIDI_CHANNEL - 1  # control change on related midi channel
-        for i in range(16):
-            # knobs
-            knob_name = "knob" + str(i+1)
-            data_byte_1 = self.KNOB_CC[knob_name]
+        # knobs
+        for index, knob_name in enumerate(self._knob_names):
+            data_byte_1 = self._knob_cc[index]
             data_byte_2 = self.knob_values[knob_name]
-            knobID = int(self.KNOB_SYSEX_ID[knob_name])
-            self._updateKnobPosition(knobID, data_byte_2)
+            self._updateKnobPosition(self._knob_sysex[index], data_byte_2)
             msg = [status_byte, data_byte_1, data_byte_2]
-            self.midiports.midiout_arturia.send_message(msg)
-            self.midiports.midiout_loopbe.send_message(msg)
-            # pads
-            pad_name = "pad" + str(i+1)
+            self._send(self.midiports.midiout_arturia, msg)
+            self._send(self.midiports.midiout_loopbe, msg)
+        # pads
+        for pad_name in self.PAD_NOTE_VALUES:
             self._updatePadColour(pad_name, 2)
-            
-
-            #msg = [240, 0, 32, 107, 127, 66, 2, 0, 16, 112, 4, 247]  #makes first pad green as a test
-            #self.midiports.midiout_arturia.send_message(msg)
+        self.renderer.flush()  # send the initial state straight away rather than on the next frame
 
     def _callback(self, msg, data):
-        status_byte, data_byte_1, data_byte_2 = msg[0]
-        msg_type = MIDI_MESSAGE_TYPES[status_byte//16]
-        msg_channel = (status_byte%16) + 1
-        # Catch messages to ignore
-        if msg_type == "System Message":
-            print(f"UNEXPECTED SYSTEM MESSAGE: from {self.NAME}")
-            return
-        if msg_channel != self.MIDI_CHANNEL: 
-            print(f"UNEXPECTED CHANNEL MESSAGE: from {self.NAME} on channel ({msg_channel})")
-            return
-        if msg_type == "Note Off":
-            return
-        if msg_type == "Channel Pressure (Aftertouch)":
-            return  #Ignore all aftertouch messages from pads
-        if msg_type == "Polyphonic Key Pressure (Aftertouch)":
-            return  #Ignore all aftertouch messages from pads
-        # Messages requiring action
-        if msg_type == "Control Change":
-            #Mod wheel - used as another way of setting self.target_knob_name value
-            if data_byte_1 == 1:
-                data_byte_1 = self.KNOB_CC[self.target_knob_name]
-                self.knob_values[self.target_knob_name] = data_byte_2
-                knob_id = int(self.KNOB_SYSEX_ID[self.target_knob_name])
-                self._updateKnobPosition(knob_id, data_byte_2)
-                msg = [status_byte, data_byte_1, data_byte_2]
-                self.midiports.midiout_loopbe.send_message(msg)
-                return
-            # knob turn
-            knob_name = get_dict_key(self.KNOB_CC, data_byte_1)
-            if knob_name:
-                #Check knob value not undergoing transition - stop transition if so
-                if knob_name in self.PAD_LINKED_TO_KNOB:
-                    if knob_name in threads:
-                        threads.remove(knob_name)
-                        self._updatePadColour(knob_name, 2)
-                        # knob_id = int(self.KNOB_SYSEX_ID[knob_name])
-                        knob_id = self.KNOB_SYSEX_ID[knob_name]
-                        knob_value = self.knob_values[knob_name]
-                        self._updateKnobPosition(knob_id, knob_value)
-                        return 0
-                #Send knob value            
-                self.knob_values[knob_name] = data_byte_2
-            msg = [status_byte, data_byte_1, data_byte_2]
-            self.midiports.midiout_loopbe.send_message(msg)
-            return
-        if msg_type == "Note On":
-            pad_name = get_dict_key(self.PAD_NOTE_VALUES, data_byte_1)
-            if pad_name and pad_name in self.PAD_ROTARY_SWITCH:  # Pressed pad for switching organ rotary
-                status_byte = 0xB0 + self.MIDI_CHANNEL_ORGAN - 1  # Change status_byte to CC on specified midi channel (must be same as organ channel)
-                data_byte_1 = 1  # Change to CC1 (normally mod wheel)
-                if self.rotary_on == True:
-                    self.rotary_on = False
-                    data_byte_2 = 0
-                else:
-                    self.rotary_on = True
-                    data_byte_2 = 127
-                msg = [status_byte, data_byte_1, data_byte_2]
-                self.midiports.midiout_loopbe.send_message(msg)
-                return
-            elif pad_name:  # Pressed another pad
-                transitionTime = 128 - data_byte_2
-                transitionTime = transitionTime*transitionTime
-                t = threading.Thread(target=self._makeTransition, args=(pad_name, transitionTime))
-                t.start()
-                return
-            elif data_byte_1 >= MIDI_NOTE_VALUES["C3"] and data_byte_1 < MIDI_NOTE_VALUES["C4"]:   # Pressed key in bottom octave on Arturia Minilab
-                self.base_pitch = data_byte_1 - MIDI_NOTE_VALUES["C1"]   # Value for equivalent note in octave C1-B1
-                self._sendAllNotesOff()
-                return
-            elif data_byte_1 >= MIDI_NOTE_VALUES["C4"] and data_byte_1 < MIDI_NOTE_VALUES["C5"]:  #Pressed key in upper octave on Arturia Minilab
-                self.octave_transpose = data_byte_1 - MIDI_NOTE_VALUES["C4"]
-                data_byte_1 = self.base_pitch + (12*self.octave_transpose)
-                if data_byte_1 in self.notes_on:   #Turn off note
-                    self.notes_on.remove(data_byte_1)
-                    status_byte = 0x80 + self.MIDI_CHANNEL - 1    #Note Off on specified midi channel
-                    data_byte_2 = 0
-                    msg = [status_byte, data_byte_1, data_byte_2]
-                    self.midiports.midiout_loopbe.send_message(msg)
-                    return
-                else:   #Turn on note
-                    self.notes_on.append(data_byte_1)
-                    msg = [status_byte, data_byte_1, data_byte_2]
-                    self.midiports.midiout_loopbe.send_message(msg)
-                    return
-            else:
-                # msg = [status_byte, data_byte_1, data_byte_2]
-                # self.midiports.midiout_loopbe.send_message(msg)
-                print(f"UNEXPECTED CHANNEL MESSAGE: Note On for {note_value_to_name(data_byte_1)} is outside of expected range (C3-B4)")
-                return
-        # If reaches here, log unexpected message after sending
-        msg = [status_byte, data_byte_1, data_byte_2]
-        self.midiports.midiout_loopbe.send_message(msg)
-        print(f"UNEXPECTED CHANNEL MESSAGE: {msg} from Arteria")
+        message = msg[0]
+        msg_type, msg_channel, handler = self._dispatch[message[0]]
+        self.stats.received[msg_type] += 1
+        handler(message, msg_channel)
 
+    def _timedCallback(self, msg, data):
+        started = time.perf_counter_ns()
+        message = msg[0]
+        msg_type, msg_channel, handler = self._dispatch[message[0]]
+        handler(message, msg_channel)
+        self.stats.record(msg_type, time.perf_counter_ns() - started)
 
-    def _makeTransition(self, pad_name, t):
-        # Check if thread already running for this pad
-        if pad_name in threads:
-            threads.remove(pad_name)
-            self._updatePadColour(pad_name, 2)
-            return 0
+    def _send(self, midiout, msg):
+        self.stats.sent[msg[0] >> 4] += 1
+        midiout.send_message(msg)
+
+    def _buildDispatchTable(self):
+        return compile_rules(self._buildRules(), self, self._onSystemMessage)
+
+    def _buildRules(self):
+        channels = (self.MIDI_CHANNEL,)
+        rotary_pad_notes = {self.PAD_NOTE_VALUES[pad_name] for pad_name in self.PAD_ROTARY_SWITCH}
+        sweep_pad_notes = set(self.PAD_NOTE_VALUES.values()) - rotary_pad_notes
+        return [
+            Rule(types=(SYSTEM_MESSAGE,), transform=self._onSystemMessage),
+            Rule(types=(NOTE_OFF, POLY_PRESSURE, CHANNEL_PRESSURE), channels=channels),  # Ignore note offs and all aftertouch messages from pads
+            Rule(types=(CONTROL_CHANGE,), channels=channels, data1=(1,), transform=self._onModWheel, outputs=("midiout_loopbe",)),
+            Rule(types=(CONTROL_CHANGE,), channels=channels, data1=set(self.KNOB_CC.values()), transform=self._onKnobTurn, outputs=("midiout_loopbe",)),
+            Rule(types=(CONTROL_CHANGE,), channels=channels, outputs=("midiout_loopbe",)),
+            Rule(types=(NOTE_ON,), channels=channels, data1=rotary_pad_notes, transform=self._toggleRotary, outputs=("midiout_loopbe",)),
+            Rule(types=(NOTE_ON,), channels=channels, data1=sweep_pad_notes, transform=self._onPadPress),
+            Rule(types=(NOTE_ON,), channels=channels, data1=range(MIDI_NOTE_VALUES["C3"], MIDI_NOTE_VALUES["C4"]), transform=self._setBasePitch),   # bottom octave on Arturia Minilab
+            Rule(types=(NOTE_ON,), channels=channels, data1=range(MIDI_NOTE_VALUES["C4"], MIDI_NOTE_VALUES["C5"]), transform=self._toggleNote, outputs=("midiout_loopbe",)),   # upper octave on Arturia Minilab
+            Rule(types=(NOTE_ON,), channels=channels, transform=self._onNoteOutOfRange),
+            Rule(channels=channels, transform=self._onUnexpectedMessage, outputs=("midiout_loopbe",)),
+            Rule(transform=self._onUnexpectedChannel),
+        ]
+
+    def _onSystemMessage(self, message, msg_channel):
+        self.stats.ignored[SYSTEM_MESSAGE] += 1
+        diagnostics.log(LOG_UNEXPECTED_SYSTEM, self.NAME)
+
+    def _onUnexpectedChannel(self, message, msg_channel):
+        self.stats.ignored[message[0] >> 4] += 1
+        diagnostics.log(LOG_UNEXPECTED_CHANNEL, self.NAME, msg_channel)
+
+    def _onUnexpectedMessage(self, message, msg_channel):
+        # Log unexpected message and send it on
+        diagnostics.log(LOG_UNEXPECTED_MESSAGE, self.NAME, message)
+        return message
+
+    def _onModWheel(self, message, msg_channel):
+        #Mod wheel - used as another way of setting self.target_knob_name value
+        status_byte, data_byte_1, data_byte_2 = message
+        data_byte_1 = self._knob_cc[self._target_knob]
+        self.knob_values[self.target_knob_name] = data_byte_2
+        self._updateKnobPosition(self._knob_sysex[self._target_knob], data_byte_2)
+        self._retargetSweeps(data_byte_2)
+        return [status_byte, data_byte_1, data_byte_2]
+
+    def _onKnobTurn(self, message, msg_channel):
+        status_byte, data_byte_1, data_byte_2 = message
+        knob_index = self._knob_by_cc[data_byte_1]
+        knob_name = self._knob_names[knob_index]
+        #Check knob value not undergoing transition - stop transition if so
+        knob_id = self._knob_sysex[knob_index]
+        self.renderer.observe_knob_position(knob_id, data_byte_2)  # the device already shows where the knob was turned to
+        sweep = self.sweeps.pop(knob_name)
+        if sweep and self.scheduler.cancel(sweep):
+            self._updatePadColour(sweep.pad_name, 2)
+            knob_value = self.knob_values[knob_name]
+            self._updateKnobPosition(knob_id, knob_value)
+            return None
+        #Send knob value
+        self.knob_values[knob_name] = data_byte_2
+        if knob_index == self._target_knob:
+            self._retargetSweeps(data_byte_2)
+        return message
+
+    def _retargetSweeps(self, target_value):
+        # The target knob has moved - running sweeps carry on from where they are towards its new value
+        for sweep in self.sweeps.running():
+            if sweep.knob_name != self.target_knob_name and sweep.target_value != target_value:
+                self.scheduler.retarget(sweep, target_value)
+
+    def _toggleRotary(self, message, msg_channel):
+        # Pressed pad for switching organ rotary
+        status_byte = 0xB0 + self.MIDI_CHANNEL_ORGAN - 1  # Change status_byte to CC on specified midi channel (must be same as organ channel)
+        data_byte_1 = 1  # Change to CC1 (normally mod wheel)
+        if self.rotary_on == True:
+            self.rotary_on = False
+            data_byte_2 = 0
         else:
-            threads.append(pad_name)
-        # Define value variables
+            self.rotary_on = True
+            data_byte_2 = 127
+        return [status_byte, data_byte_1, data_byte_2]
+
+    def _onPadPress(self, message, msg_channel):
+        # Pressed another pad
+        pad_name = self._pad_by_note[message[1]]
+        transitionTime = 128 - message[2]
+        transitionTime = transitionTime*transitionTime
+        self._makeTransition(pad_name, transitionTime)
 
+    def _setBasePitch(self, message, msg_channel):
+        self.base_pitch = message[1] - MIDI_NOTE_VALUES["C1"]   # Value for equivalent note in octave C1-B1
+        self._sendAllNotesOff()
+
+    def _toggleNote(self, message, msg_channel):
+        status_byte, data_byte_1, data_byte_2 = message
+        self.octave_transpose = data_byte_1 - MIDI_NOTE_VALUES["C4"]
+        data_byte_1 = self.base_pitch + (12*self.octave_transpose)
+        if data_byte_1 in self.notes_on:   #Turn off note
+            self.notes_on.remove(data_byte_1)
+            status_byte = 0x80 + self.MIDI_CHANNEL - 1    #Note Off on specified midi channel
+            data_byte_2 = 0
+        else:   #Turn on note
+            self.notes_on.append(data_byte_1)
+        return [status_byte, data_byte_1, data_byte_2]
+
+    def _onNoteOutOfRange(self, message, msg_channel):
+        self.stats.ignored[NOTE_ON] += 1
+        diagnostics.log(LOG_NOTE_OUT_OF_RANGE, MIDI_NOTE_NAMES[message[1]])
+
+    def _makeTransition(self, pad_name, t):
         knob_name = self.PAD_LINKED_TO_KNOB[pad_name]
+        # Check if a sweep is already running for this pad - pressing it again stops the sweep (one that has already
+        # run its last step is finished, so the press starts a new one)
+        running = self.sweeps.get(knob_name)
+        if running and running.pad_name == pad_name and running.step < running.steps:
+            self.sweeps.discard(running)
+            if self.scheduler.cancel(running):
+                self._updatePadColour(pad_name, 2)
+            return 0
+        # Define value variables
         initialValue = self.knob_values[knob_name]
         targetValue = self.knob_values[self.target_knob_name]
-        incrementValue = (targetValue-initialValue)/self.TRANSITION_STEPS
+        sweep = Sweep(knob_name, pad_name, initialValue, targetValue, self.TRANSITION_STEPS, t*0.00003, self._sweepStep, self._sweepFinished, self.SWEEP_MODE)
+        # Only one sweep per knob - a different pad linked to the same knob takes over from the running sweep
+        previous = self.sweeps.put(sweep)
+        if previous and self.scheduler.cancel(previous):
+            self._updatePadColour(previous.pad_name, 2)
+        self.scheduler.start(sweep)
+
+    def _sweepStep(self, sweep):
+        # Runs on the scheduler thread for each step of a sweep
         status_byte = 0xB0 + self.MIDI_CHANNEL - 1 # control change on specified midi channel
-        data_byte_1 = self.KNOB_CC[knob_name]
-        # Send midi messages using loop
-        j = 1
-        while j <= self.TRANSITION_STEPS and pad_name in threads:
-            tempValue = initialValue + (j*incrementValue)
-            data_byte_2 = int(tempValue)
-            msg = [status_byte, data_byte_1, data_byte_2]
-            self.midiports.midiout_loopbe.send_message(msg)
-            self.knob_values[knob_name] = data_byte_2
-            self._updatePadColour(pad_name, j)
-            time.sleep(t*0.00003)        
-            j += 1
+        data_byte_1 = self._knob_cc[self._knob_index[sweep.knob_name]]
+        data_byte_2 = sweep.value()
+        msg = [status_byte, data_byte_1, data_byte_2]
+        self._send(self.midiports.midiout_loopbe, msg)
+        self.knob_values[sweep.knob_name] = data_byte_2
+        self._updatePadColour(sweep.pad_name, sweep.step)
+        if sweep.step >= sweep.steps:
+            self.sweeps.discard(sweep)  # done - a press from now on starts a new sweep rather than stopping this one
+
+    def _sweepFinished(self, sweep):
+        self.sweeps.discard(sweep)
+        # The last step may have left the pad on its blink colour
+        self._updatePadColour(sweep.pad_name, 2)
         # Update knob position
-        knobID = int(self.KNOB_SYSEX_ID[knob_name])
-        self._updateKnobPosition(knobID, self.knob_values[knob_name])
-        if pad_name in threads:
-            threads.remove(pad_name)
-    
+        self._updateKnobPosition(self._knob_sysex[self._knob_index[sweep.knob_name]], self.knob_values[sweep.knob_name])
+
     def _sendAllNotesOff(self):
         for note in self.notes_on:
             status_byte = 0x80 + self.MIDI_CHANNEL - 1   # Note Off on specified midi channel
             data_byte_1 = note
             data_byte_2 = 0
             msg = [status_byte, data_byte_1, data_byte_2]
-            self.midiports.midiout_loopbe.send_message(msg)
+            self._send(self.midiports.midiout_loopbe, msg)
         self.notes_on.clear()
 
     def _updateKnobPosition(self, knobID, knobValue):
-        # Sends a SysEx message back to Arturia
-        msg = [0xF0, 0, 32, 107, 127, 66, 2, 0, 0, knobID, knobValue, 247]
-        self.midiports.midiout_arturia.send_message(msg)
+        # Queues a SysEx message back to Arturia (sent on the renderer's next frame if the value changed)
+        self.renderer.set_knob_position(knobID, knobValue)
 
     def _updatePadColour(self, pad_name, j):
-        # Sends a SysEx message back to Arturia
+        # Queues a SysEx message back to Arturia (sent on the renderer's next frame if the colour changed)
         padNo = self.PAD_NOTE_VALUES[pad_name] + 112  # note: this only works while pad notes start at 0
         padNo = int(padNo)
         c = self.PAD_COLOURS[pad_name]
@@ -289,8 +2395,7 @@ class Arturia:
                 c = 4  # green
             else:
                 c = 0
-        msg = [240, 0, 32, 107, 127, 66, 2, 0, 16, padNo, c, 247]
-        self.midiports.midiout_arturia.send_message(msg)
+        self.renderer.set_pad_colour(padNo, c)
 
 # Useful Reference Dictionaries
 MIDI_MESSAGE_TYPES = {
@@ -304,6 +2409,29 @@ MIDI_MESSAGE_TYPES = {
     0xF: "System Message"
 }
 
+# Message type codes (upper 4 bits of the status byte)
+NOTE_OFF = 0x8
+NOTE_ON = 0x9
+POLY_PRESSURE = 0xA
+CONTROL_CHANGE = 0xB
+PROGRAM_CHANGE = 0xC
+CHANNEL_PRESSURE = 0xD
+PITCH_BEND = 0xE
+SYSTEM_MESSAGE = 0xF
+
+# Diagnostic log codes (index into LOG_FORMATS)
+LOG_UNEXPECTED_SYSTEM = 0
+LOG_UNEXPECTED_CHANNEL = 1
+LOG_UNEXPECTED_MESSAGE = 2
+LOG_NOTE_OUT_OF_RANGE = 3
+
+LOG_FORMATS = [
+    "UNEXPECTED SYSTEM MESSAGE: from {0}",
+    "UNEXPECTED CHANNEL MESSAGE: from {0} on channel {1}",
+    "UNEXPECTED CHANNEL MESSAGE: {1} from {0}",
+    "UNEXPECTED CHANNEL MESSAGE: Note On for {0} is outside of expected range (C3-B4)",
+]
+
 MIDI_NOTE_VALUES = {
     "C0": 12, "C#0": 13, "D0": 14, "D#0": 15, "E0": 16, "F0": 17, "F#0": 18, "G0": 19, "G#0": 20, "A0": 21, "A#0": 22, "B0": 23, 
     "C1": 24, "C#1": 25, "D1": 26, "D#1": 27, "E1": 28, "F1": 29, "F#1": 30, "G1": 31, "G#1": 32, "A1": 33, "A#1": 34, "B1": 35, 
@@ -315,37 +2443,194 @@ MIDI_NOTE_VALUES = {
     "C7": 96, "C#7": 97, "D7": 98, "D#7": 99, "E7": 100, "F7": 101, "F#7": 102, "G7": 103, "G#7": 104, "A7": 105, "A#7": 106, "B7": 107
 }
 
+CAPTURE_MAGIC = b"MIDICAP1"
+CAPTURE_RECORD = struct.Struct("<BBBBI")  # header, three message bytes, delta time in microseconds
+CAPTURE_PORT_IDS = {"midiin_arturia": 0, "midiin_roland": 1, "midiin_loopbe": 2}
+PORT_LABELS = {"arturia": "Arturia", "roland": "Roland", "loopbe": "LoopBe"}
+DEFAULT_PORT_NAMES = {"arturia": "arturia", "roland": "umc", "loopbe": "loopbe internal midi 1"}
+DEFAULT_PROFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles", "default.toml")
+PORT_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".port_cache.json")
+
 # Useful Functions
-def note_value_to_name(value):
-    for key, val in MIDI_NOTE_VALUES.items():
-        if val == value:
-            return key
-    return None
-
-def get_dict_key(my_dict, my_val):
-    # list out key and values
-    key_list = list(my_dict.keys())
-    val_list = list(my_dict.values())
-    # return key which matches value (or None if not found)
-    try:
-        position = val_list.index(my_val)
-        return key_list[position]
-    except ValueError:
-        return None
+def load_capture(path):
+    # Memory-maps an InputCapture file - returns (start time in seconds since the epoch, uint64 record view)
+    # The view is zero-copy; keep it (and so the mapping) alive while it is in use
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[:8] != CAPTURE_MAGIC:
+        raise ValueError(f"{path}: not an input capture")
+    started = struct.unpack("<Q", mapped[8:16])[0] / 1e6
+    usable = 16 + (len(mapped) - 16) // 8 * 8  # ignore a record cut short by a crash
+    records = memoryview(mapped)[16:usable].cast("Q")
+    return started, records
+
+def iter_capture(records):
+    # Yields (port id, delta time in seconds, message) from load_capture records, joining continued messages
+    pending = None
+    for record in records:
+        if sys.byteorder != "little":
+            record = int.from_bytes(record.to_bytes(8, "big"), "little")
+        port_id = record & 0x0F
+        length = (record >> 4) & 0x03
+        data = [(record >> (8 + 8 * i)) & 0xFF for i in range(length)]
+        if record & 0x40:
+            if pending is not None and pending[0] == port_id:
+                pending[2].extend(data)
+            continue  # a continuation that does not follow its own port's message cannot be joined, so it is dropped
+        if pending is not None:
+            yield pending[0], pending[1], pending[2]
+        pending = (port_id, (record >> 32) / 1e6, data)
+    if pending is not None:
+        yield pending[0], pending[1], pending[2]
+
+def as_port_spec(spec):
+    # Plain strings are substrings of the port name, as they always have been
+    if isinstance(spec, PortSpec):
+        return spec
+    return PortSpec(spec)
+
+def load_device_profile(path):
+    # Reads and validates a .toml or .json device profile (raises DeviceProfileError if it is invalid)
+    if path.lower().endswith(".json"):
+        with open(path) as f:
+            data = json.load(f)
+    else:
+        import tomllib  # Python 3.11+ - use a .json profile on older versions
+        with open(path, "rb") as f:
+            data = tomllib.load(f)
+    if not isinstance(data, dict):
+        raise DeviceProfileError(f"{path}: a profile must be a table of sections")
+    return DeviceProfile(data, path)
+
+def is_note_off(message):
+    # A Note On with velocity 0 is a Note Off too
+    return message[0] >> 4 == NOTE_OFF or (message[0] >> 4 == NOTE_ON and message[2] == 0)
+
+def build_reverse_index(my_dict):
+    # Returns a 128-entry list mapping each data byte value to its key in my_dict (None where unused)
+    # the first key wins if two keys share a value
+    index = [None] * 128
+    for key, val in my_dict.items():
+        if index[val] is None:
+            index[val] = key
+    return index
+
+MIDI_NOTE_NAMES = build_reverse_index(MIDI_NOTE_VALUES)  # note value -> note name
+
+def compile_rules(rules, device, fallback):
+    # Compiles a device's routing rules into a (type code, channel, handler) entry for each of the 256 status bytes
+    # so callbacks do one index and one call - the first matching rule wins and fallback handles anything unmatched
+    compiled = [(rule, rule.compile(device)) for rule in rules]
+    data_handlers = {}  # candidate rules -> handler, shared between status bytes with the same candidates
+    table = []
+    for status_byte in range(256):
+        msg_type = status_byte >> 4
+        msg_channel = (status_byte & 0x0F) + 1
+        if status_byte < 0x80:  # data bytes in the status position are treated as system noise
+            table.append((msg_type, msg_channel, fallback))
+            continue
+        candidates = tuple(entry for entry in compiled if entry[0].matches_status(msg_type, msg_channel))
+        if candidates not in data_handlers:
+            data_handlers[candidates] = _compile_data_dispatch(candidates, fallback)
+        table.append((msg_type, msg_channel, data_handlers[candidates]))
+    return tuple(table)
+
+def _compile_data_dispatch(candidates, fallback):
+    # Specialises the handler for one status byte: the first rule directly if it matches every data byte,
+    # otherwise a 128-entry table indexed by the first data byte
+    if not candidates:
+        return fallback
+    if candidates[0][0].data1 is None and candidates[0][0].data2 is None:
+        return candidates[0][1]
+    slot_handlers = {}
+    by_data1 = []
+    for data_byte_1 in range(128):
+        slot = []
+        for rule, handler in candidates:
+            if rule.data1 is None or data_byte_1 in rule.data1:
+                slot.append((rule, handler))
+                if rule.data2 is None:
+                    break  # always matches - later rules can never be reached
+        slot = tuple(slot)
+        if slot not in slot_handlers:
+            slot_handlers[slot] = _compile_data2_dispatch(slot, fallback)
+        by_data1.append(slot_handlers[slot])
+    by_data1 = tuple(by_data1)
+    def handler(message, msg_channel):
+        by_data1[message[1]](message, msg_channel)
+    return handler
+
+def _compile_data2_dispatch(slot, fallback):
+    if not slot:
+        return fallback
+    if slot[0][0].data2 is None:
+        return slot[0][1]
+    def handler(message, msg_channel):
+        for rule, rule_handler in slot:
+            if rule.data2 is None or (len(message) > 2 and message[2] in rule.data2):
+                rule_handler(message, msg_channel)
+                return
+        fallback(message, msg_channel)
+    return handler
+
+diagnostics = RingLogger(LOG_FORMATS)  # shared by every device callback
+router_stats = RouterStats()
 
 # MAIN PROCEDURE
-threads = []
-midiports = MidiPorts()
-midiports.open_all_ports()
+STATS_FILE = None  # set to a path to have a JSON stats snapshot rewritten every STATS_INTERVAL seconds
+STATS_INTERVAL = 5
+CAPTURE_FILE = None  # set to a path to record every input event into a binary capture (see InputCapture)
+CALLBACK_TIMING = False  # set True to add each message type's processing time to the device stats (STATS_FILE turns it on too)
+LATENCY_TRACKING = False  # set True to add per input port queue / python / output latency histograms to the stats
+ASYNC_CORE = False  # set True to route on one asyncio event loop (AsyncCore) instead of the rtmidi callback threads
+POLLING_INPUT = False  # set True to drain every input port from one polling thread (PollingCore) instead
+
+def main(profile_path=DEFAULT_PROFILE):
+    profile = load_device_profile(profile_path)
+    diagnostics.start()
+    router_stats.install_signal_handler(STATS_FILE)  # kill -USR1 <pid> dumps stats (to stdout unless STATS_FILE is set)
+    if STATS_FILE:
+        router_stats.start_file_writer(STATS_FILE, STATS_INTERVAL)
+    poller = None
+    if ASYNC_CORE:
+        core = AsyncCore(port_cache=PORT_CACHE_FILE)
+        midiports = core.midiports
+    elif POLLING_INPUT:
+        poller = PollingCore(port_cache=PORT_CACHE_FILE)
+        midiports = poller.midiports
+    else:
+        midiports = MidiPorts(port_cache=PORT_CACHE_FILE)
+    midiports.open_all_ports(profile.port_names)
+    if profile.outputs is not None:
+        midiports.set_output_budgets(profile.outputs)
+
+    roland = Roland(midiports, profile)
+    roland.initialise_callback(timed=CALLBACK_TIMING or bool(STATS_FILE))
+    roland.initialise_bassmode()  # This asks the user to write 'y' or 'n'
+
+    arturia = Arturia(midiports, profile)
+    arturia.initialise_callback(timed=CALLBACK_TIMING or bool(STATS_FILE))
+    arturia.initialise_knobs_and_pads()
 
-roland = Roland(midiports)
-roland.initialise_callback()
-roland.initialise_bassmode()  # This asks the user to write 'y' or 'n'
+    watcher = PortWatcher(midiports)  # reopens ports if a device is unplugged and plugged back in
+    watcher.start()
+    if CAPTURE_FILE:
+        midiports.start_capture(CAPTURE_FILE)
+    if LATENCY_TRACKING:
+        midiports.start_latency_tracking()
+    if poller is not None:
+        poller.start()
 
-arturia = Arturia(midiports)
-arturia.initialise_callback()
-arturia.initialise_knobs_and_pads()
+    if ASYNC_CORE:
+        asyncio.run(core.run_until_input("\nAbleton mapper is running (Roland and Arturia, asyncio core)"))
+    else:
+        k = input("\nAbleton mapper is running (Roland and Arturia)")
 
-k = input("\nAbleton mapper is running (Roland and Arturia)")
+    watcher.stop()
+    if poller is not None:
+        poller.stop()
+    midiports.stop_capture()
+    midiports.close_all_ports()
 
-midiports.close_all_ports()
\ No newline at end of file
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PROFILE)  # optional argument: path to a device profile
@@ -0,0 +1,343 @@
+import argparse, collections, multiprocessing, threading
+from multiprocessing import connection, shared_memory
+from midi_router import (MidiPorts, VirtualBackend, PortWatcher, Roland, Arturia, load_device_profile, diagnostics,
+                         DEFAULT_PROFILE, NOTE_ON, CONTROL_CHANGE)
+
+# Runs each input device's handler in a worker process of its own, so busy controllers no longer share one GIL
+# The state the handlers keep (Roland's expression pedal, Arturia's knob values and held notes) lives in one
+# multiprocessing.shared_memory block that every process maps - each value is a byte written only by its own device's
+# worker, so nothing is locked
+# Output goes through a single writer process, the only one with the output ports open, which feeds the usual
+# OutputSchedulers from a pipe per worker. Each pipe write carries every message that gathered while the previous one
+# was being written: [output index (SHARD_OUTPUTS), length (2 bytes, little-endian), message bytes] per message
+# Usage: python midi_shards.py [profile] [--devices roland,arturia]
+
+SHARD_OUTPUTS = ("midiout_arturia", "midiout_roland", "midiout_loopbe")  # first byte of every message sent to the writer
+HELD_NOTES = 128
+
+class SharedKnobValues:
+    # dict-like view of one Arturia's knob values in a SharedDeviceState
+    def __init__(self, buf, offset, knob_names):
+        self._buf = buf
+        self._index = {knob_name: offset + i for i, knob_name in enumerate(knob_names)}
+
+    def __getitem__(self, knob_name):
+        return self._buf[self._index[knob_name]]
+
+    def __setitem__(self, knob_name, value):
+        self._buf[self._index[knob_name]] = value
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def keys(self):
+        return self._index.keys()
+
+    def items(self):
+        return [(knob_name, self._buf[index]) for knob_name, index in self._index.items()]
+
+class SharedNoteList:
+    # list-like view of one Arturia's held notes: a count byte, then the notes in the order they were turned on
+    # A note is written before the count that includes it, so another process never reads a note that is not there yet
+    def __init__(self, buf, offset):
+        self._buf = buf
+        self._offset = offset
+
+    def _notes(self):
+        count = self._buf[self._offset]
+        return bytes(self._buf[self._offset + 1:self._offset + 1 + count])
+
+    def __contains__(self, note):
+        return note in self._notes()
+
+    def __iter__(self):
+        return iter(self._notes())  # a snapshot, so the list can be changed while it is being walked
+
+    def __len__(self):
+        return self._buf[self._offset]
+
+    def append(self, note):
+        count = self._buf[self._offset]
+        if count == HELD_NOTES:
+            raise IndexError("held note list is full")
+        self._buf[self._offset + 1 + count] = note
+        self._buf[self._offset] = count + 1
+
+    def remove(self, note):
+        notes = list(self._notes())
+        notes.remove(note)  # ValueError if it is not held, like a list
+        self._buf[self._offset + 1:self._offset + 1 + len(notes)] = bytes(notes)
+        self._buf[self._offset] = len(notes)
+
+    def clear(self):
+        self._buf[self._offset] = 0
+
+class SharedDeviceState:
+    # One shared memory block holding the state of every sharded device, in the order of devices:
+    # a Roland has one byte (expression pedal), an Arturia one byte per knob then its held notes (count + 128 notes)
+    # Created by the parent (name=None) and attached to by name in the workers
+    def __init__(self, devices, knob_values, name=None):
+        self.devices = tuple(devices)
+        self.knob_names = tuple(knob_values)
+        self.offsets = []
+        size = 0
+        for kind in self.devices:
+            self.offsets.append(size)
+            size += 1 if kind == "roland" else len(self.knob_names) + 1 + HELD_NOTES
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=max(size, 1) if self.owner else 0)
+        self.name = self.shm.name
+        if self.owner:
+            for index, kind in enumerate(self.devices):
+                if kind == "arturia":
+                    for knob_name, value in knob_values.items():
+                        self.knob_values(index)[knob_name] = value
+
+    def knob_values(self, index):
+        return SharedKnobValues(self.shm.buf, self.offsets[index], self.knob_names)
+
+    def notes_on(self, index):
+        return SharedNoteList(self.shm.buf, self.offsets[index] + len(self.knob_names))
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class ShardedRoland(Roland):
+    # Roland whose expression pedal value is kept in shared memory
+    def __init__(self, midiports, profile, state, index):
+        self._state_buf = state.shm.buf
+        self._state_offset = state.offsets[index]
+        super().__init__(midiports, profile)
+
+    @property
+    def exp_pedal_value(self):
+        return self._state_buf[self._state_offset]
+
+    @exp_pedal_value.setter
+    def exp_pedal_value(self, value):
+        self._state_buf[self._state_offset] = value
+
+class ShardedArturia(Arturia):
+    # Arturia whose knob values and held notes are kept in shared memory
+    def __init__(self, midiports, profile, state, index):
+        super().__init__(midiports, profile)
+        self.knob_values = state.knob_values(index)
+        self.notes_on = state.notes_on(index)
+
+SHARDED_DEVICES = {"roland": ShardedRoland, "arturia": ShardedArturia}
+
+class ShardLink:
+    # A worker's end of its pipe to the writer: any thread (input callback, sweeps, feedback renderer) appends to the
+    # inbox and the link's own thread sends whatever has gathered as one pipe write, so a busy worker makes one
+    # write per batch rather than per message and an idle one sends each message straight away
+    def __init__(self, conn):
+        self._conn = conn
+        self._inbox = collections.deque()  # framed messages - deque appends / pops are atomic so producers take no lock
+        self._idle = False
+        self._closing = False
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="ShardLink", daemon=True)
+        self._thread.start()
+
+    def output(self, port_index):
+        return ShardOutput(self, port_index)
+
+    def send(self, port_index, message):
+        length = len(message)
+        self._inbox.append(bytes((port_index, length & 0xFF, length >> 8)) + bytes(message))
+        if self._idle:
+            self._wakeup.set()
+
+    def close(self):
+        # Sends what is still waiting, then closes the pipe (the writer stops once every worker's pipe is closed)
+        self._closing = True
+        self._wakeup.set()
+        self._thread.join()
+        self._conn.close()
+
+    def _run(self):
+        inbox = self._inbox
+        while True:
+            if not inbox:
+                if self._closing:
+                    return
+                self._idle = True
+                self._wakeup.clear()
+                if not inbox:
+                    self._wakeup.wait()
+                self._idle = False
+                continue
+            batch = []
+            while inbox:
+                batch.append(inbox.popleft())
+            self._conn.send_bytes(b"".join(batch))
+
+class ShardOutput:
+    # Stands in for an output port in a worker
+    def __init__(self, link, port_index):
+        self._link = link
+        self._port_index = port_index
+
+    def send_message(self, message):
+        self._link.send(self._port_index, message)
+
+def make_backend(name):
+    return VirtualBackend(capture=False) if name == "virtual" else None  # None is rtmidi
+
+def shard_load(device, count):
+    # count messages that each produce one output (for benchmarks) - notes for a Roland, knob turns for an Arturia
+    if isinstance(device, Roland):
+        status_byte = (NOTE_ON << 4) + device.MIDI_CHANNEL - 1
+        return [[status_byte, 36 + i % 48, 1 + i % 127] for i in range(count)]
+    status_byte = (CONTROL_CHANGE << 4) + device.MIDI_CHANNEL - 1
+    knob_ccs = list(device.KNOB_CC.values())
+    return [[status_byte, knob_ccs[i % len(knob_ccs)], i % 128] for i in range(count)]
+
+def run_worker(kind, index, profile_path, state_name, conn, ready, go, stop, options):
+    # Worker process: one device handler on its own input port (load > 0 injects that many messages on virtual ports
+    # once go is set and then exits, for benchmarks)
+    profile = load_device_profile(profile_path)
+    diagnostics.start()  # each process has its own logger - the device callbacks log to this one
+    state = SharedDeviceState(options["devices"], profile.arturia["knob_values"], state_name)
+    midiports = MidiPorts(make_backend(options["backend"]), writers=False)
+    midiports.open_all_ports({kind: profile.port_names[kind]}, directions=("in",))
+    link = ShardLink(conn)
+    for port_index, attribute in enumerate(SHARD_OUTPUTS):
+        setattr(midiports, attribute, link.output(port_index))
+    device = SHARDED_DEVICES[kind](midiports, profile, state, index)
+    device.initialise_callback()
+    if kind == "roland":
+        device.bass_mode = options["bass_mode"]
+    else:
+        device.initialise_knobs_and_pads()
+    watcher = None
+    if options["backend"] != "virtual":
+        watcher = PortWatcher(midiports)
+        watcher.start()
+    load = shard_load(device, options["load"]) if options["load"] else None
+    ready.set()
+    if load is not None:
+        go.wait()
+        midiin = getattr(midiports, "midiin_" + kind)
+        for message in load:
+            midiin.inject(message, 0.0)
+    else:
+        stop.wait()
+    if watcher is not None:
+        watcher.stop()
+    link.close()
+    diagnostics.drain()  # print what the logger thread has not got to yet
+    del device, midiports
+    state.close()
+
+def run_writer(conns, profile_path, results, options):
+    # Writer process: owns the output ports and forwards every worker's messages to their OutputSchedulers
+    profile = load_device_profile(profile_path)
+    midiports = MidiPorts(make_backend(options["backend"]), writers=options["writers"])
+    midiports.open_all_ports(profile.port_names, directions=("out",))
+    if profile.outputs is not None:
+        midiports.set_output_budgets(profile.outputs)
+    watcher = None
+    if options["backend"] != "virtual":
+        watcher = PortWatcher(midiports)  # reopens unplugged output ports (the only direction this process opened)
+        watcher.start()
+    outputs = [getattr(midiports, attribute) for attribute in SHARD_OUTPUTS]
+    forwarded = 0
+    conns = list(conns)
+    while conns:
+        for conn in connection.wait(conns):
+            try:
+                data = conn.recv_bytes()
+            except EOFError:
+                conns.remove(conn)
+                continue
+            position = 0
+            while position < len(data):
+                end = position + 3 + (data[position + 1] | data[position + 2] << 8)
+                outputs[data[position]].send_message(list(data[position + 3:end]))
+                forwarded += 1
+                position = end
+    midiports.wait_outputs_idle(1.0)
+    results.put(("writer", forwarded))
+    if watcher is not None:
+        watcher.stop()
+    midiports.close_all_ports()
+
+class ShardedRouter:
+    # Starts a worker process per device plus the writer process (spawned, so this works the same on every platform)
+    # devices may name a kind more than once (e.g. several Rolands in a benchmark) - each gets its own state
+    def __init__(self, profile_path=DEFAULT_PROFILE, devices=("roland", "arturia"), bass_mode=False, backend="rtmidi", writers=True, load=0):
+        self.profile_path = profile_path
+        self.devices = tuple(devices)
+        self.options = {"devices": self.devices, "bass_mode": bass_mode, "backend": backend, "writers": writers, "load": load}
+        self.state = None
+        self.workers = []
+        self.writer = None
+        self.forwarded = None  # messages the writer forwarded (set by join)
+        self._context = multiprocessing.get_context("spawn")
+        self._go = self._context.Event()
+        self._stop = self._context.Event()
+        self._results = self._context.Queue()
+
+    def start(self):
+        # Returns once every worker has opened its port and set its callback
+        profile = load_device_profile(self.profile_path)
+        self.state = SharedDeviceState(self.devices, profile.arturia["knob_values"])
+        writer_conns = []
+        readies = []
+        for index, kind in enumerate(self.devices):
+            receive_conn, send_conn = self._context.Pipe(duplex=False)
+            ready = self._context.Event()
+            worker = self._context.Process(target=run_worker, name=f"shard-{kind}-{index}", daemon=True,
+                                           args=(kind, index, self.profile_path, self.state.name, send_conn, ready, self._go, self._stop, self.options))
+            worker.start()
+            send_conn.close()  # the worker holds the only sending end, so the writer sees EOF when it exits
+            writer_conns.append(receive_conn)
+            readies.append(ready)
+            self.workers.append(worker)
+        self.writer = self._context.Process(target=run_writer, name="shard-writer", daemon=True,
+                                            args=(writer_conns, self.profile_path, self._results, self.options))
+        self.writer.start()
+        for conn in writer_conns:
+            conn.close()
+        for ready in readies:
+            ready.wait()
+
+    def go(self):
+        # Starts the benchmark load in every worker
+        self._go.set()
+
+    def stop(self):
+        self._stop.set()
+        self.join()
+
+    def join(self):
+        for worker in self.workers:
+            worker.join()
+        kind, self.forwarded = self._results.get()
+        self.writer.join()
+        self.state.close()
+        return self.forwarded
+
+def main():
+    parser = argparse.ArgumentParser(description="Run each device's handler in its own process")
+    parser.add_argument("profile", nargs="?", default=DEFAULT_PROFILE, help="device profile (TOML or JSON)")
+    parser.add_argument("--devices", default="roland,arturia", help="comma separated devices, one worker process each")
+    args = parser.parse_args()
+    devices = args.devices.split(",")
+    bass_mode = False
+    if "roland" in devices:
+        prompt = "\nWould you like to turn bass mode on? (Please enter 'y' for yes or 'n' for no)\n"
+        bass_mode = input(prompt).strip().lower() == "y"
+    router = ShardedRouter(args.profile, devices, bass_mode)
+    router.start()
+    input(f"\nAbleton mapper is running ({', '.join(devices)} in {len(devices)} worker processes)")
+    router.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import argparse, json, sys, time
+from midi_router import (MidiPorts, VirtualBackend, VirtualClock, Roland, Arturia, load_device_profile, load_capture,
+                         iter_capture, DEFAULT_PROFILE, CAPTURE_PORT_IDS)
+
+# Deterministic replay of an InputCapture file through the Roland / Arturia callbacks on a virtual clock
+# Nothing waits in real time: the clock jumps from event to event, running sweep steps and feedback frames at their
+# simulated deadlines in between, so a replay runs as fast as the callbacks allow and gives the same output every time
+# Usage: python replay.py capture.bin [--write-golden golden.json | --golden golden.json]
+
+def capture_events(path):
+    # Returns [(time in ns from the start of the capture, port attribute, message)] in the order they were recorded
+    # Each port's rtmidi delta times are summed separately; a port is never allowed to run behind the one before it,
+    # so recording order is kept
+    started, records = load_capture(path)
+    attributes = {port_id: attribute for attribute, port_id in CAPTURE_PORT_IDS.items()}
+    port_times = {}
+    events = []
+    last = 0
+    for port_id, delta_time, message in iter_capture(records):
+        port_time = port_times.get(port_id, 0) + int(delta_time * 1e9 + 0.5)
+        port_times[port_id] = port_time
+        last = max(last, port_time)
+        events.append((last, attributes.get(port_id), message))
+    records.release()
+    return events
+
+def make_router(profile, bass_mode=False, clock=None):
+    # Both devices wired up as in midi_router.main, on virtual ports and a VirtualClock
+    if clock is None:
+        clock = VirtualClock()
+    midiports = MidiPorts(VirtualBackend(clock=clock.time), writers=False, clock=clock)
+    midiports.open_all_ports(profile.port_names)
+    roland = Roland(midiports, profile)
+    roland.initialise_callback()
+    roland.bass_mode = bass_mode
+    arturia = Arturia(midiports, profile)
+    arturia.initialise_callback()
+    arturia.initialise_knobs_and_pads()
+    return midiports, clock
+
+def replay(events, profile, bass_mode=False):
+    # Runs the events through a fresh router and returns (midiports, virtual end time in ns, events delivered)
+    midiports, clock = make_router(profile, bass_mode)
+    delivered = 0
+    for timestamp, attribute, message in events:
+        clock.advance_to(timestamp)
+        if attribute is None or attribute not in midiports.callbacks:
+            continue  # a port nothing listens on
+        getattr(midiports, attribute).inject(message, clock.time())
+        delivered += 1
+    while clock.next_deadline_ns() is not None:  # let running sweeps and the last feedback frame finish
+        clock.advance_to(clock.next_deadline_ns())
+    return midiports, clock.now_ns, delivered
+
+def output_log(midiports):
+    # port attribute -> [[virtual time in microseconds, message], ...] for every output port
+    log = {}
+    for attribute in sorted(vars(midiports)):
+        if attribute.startswith("midiout_"):
+            log[attribute] = [[int(round(timestamp * 1e6)), message] for timestamp, message in getattr(midiports, attribute).sent]
+    return log
+
+def first_difference(golden, outputs):
+    # Returns a description of the first output that differs from the golden log (None if they match)
+    for attribute in sorted(set(golden) | set(outputs)):
+        expected, actual = golden.get(attribute, []), outputs.get(attribute, [])
+        for index, (expected_entry, actual_entry) in enumerate(zip(expected, actual)):
+            if expected_entry != actual_entry:
+                return f"{attribute} message {index}: golden {expected_entry} replay {actual_entry}"
+        if len(expected) != len(actual):
+            return f"{attribute}: golden has {len(expected)} messages, replay has {len(actual)}"
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay an input capture on a virtual clock")
+    parser.add_argument("capture", help="file written by MidiPorts.start_capture (CAPTURE_FILE)")
+    parser.add_argument("--profile", default=DEFAULT_PROFILE, help="device profile (TOML or JSON)")
+    parser.add_argument("--bass-mode", action="store_true", help="turn Roland bass mode on")
+    golden = parser.add_mutually_exclusive_group()
+    golden.add_argument("--golden", help="compare the output with this golden file")
+    golden.add_argument("--write-golden", help="save the output as a golden file")
+    args = parser.parse_args()
+    profile = load_device_profile(args.profile)
+    events = capture_events(args.capture)
+    started = time.perf_counter()
+    midiports, end_ns, delivered = replay(events, profile, args.bass_mode)
+    elapsed = time.perf_counter() - started
+    outputs = output_log(midiports)
+    sent = sum(len(messages) for messages in outputs.values())
+    print(f"{delivered} events in, {sent} messages out, {end_ns / 1e9:.3f} s of input replayed in {elapsed * 1000:.1f} ms")
+    print(f"{delivered / elapsed:,.0f} events/s, {end_ns / 1e9 / elapsed:,.1f}x realtime")
+    if args.write_golden:
+        with open(args.write_golden, "w") as f:
+            json.dump({"events": delivered, "outputs": outputs}, f)
+    elif args.golden:
+        with open(args.golden) as f:
+            expected = json.load(f)
+        difference = first_difference(expected["outputs"], outputs)
+        if difference is not None:
+            print(f"MISMATCH {difference}")
+            sys.exit(1)
+        print(f"OK: output matches {args.golden}")
+
+if __name__ == "__main__":
+    main()